@@ -0,0 +1,221 @@
+import sys
+import os
+import glob
+import tempfile
+import shutil
+import time
+import contextlib
+import io
+import tracemalloc
+import lexer
+from goviaji_parser import read_file, parse_instructions
+from compiler import Compiler
+from goviaji import Goviaji
+from evaluation import Evaluator
+from expressions import expression_from_list
+
+
+# the bundled systems are compiled without writing a module cache into the checkout
+def load_quietly(file_name):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return Goviaji(file_name, use_module_cache=False)
+
+
+# Rule lookup must not get slower as the process runs: the candidate lists of the index are never modified by lookups
+def bench_rule_lookup(num_queries=100000, batch_size=10000):
+    goviaji = load_quietly("systems/untyped_lambda/lambda_nb_tests.goviaji")
+    rules_db = goviaji.compiler.rules_db
+
+    goals = []
+    for expr, src in goviaji.compiler.expressions_to_print.values():
+        for predicate in [goviaji.syntax_predicate_name, goviaji.value_predicate_name]:
+            goals.append(expression_from_list([predicate, expr]))
+
+        goals.append(expression_from_list([goviaji.eval_predicate_name, expr, rules_db.introduce_variable()]))
+
+    print("Rule lookup: %d queries over %d goals, %d rules" % (num_queries, len(goals), len(rules_db.rules_in_order)))
+    for batch in range(num_queries // batch_size):
+        start = time.perf_counter()
+        candidates = 0
+        for i in range(batch_size):
+            candidates += sum(1 for _ in rules_db.get_applicable_rules(goals[i % len(goals)]))
+
+        elapsed = time.perf_counter() - start
+        print("\tqueries %6d-%6d: %.2f us/query, %d applicable rules" %
+              (batch * batch_size, (batch + 1) * batch_size - 1, elapsed / batch_size * 1e6, candidates))
+
+
+# Memory allocated while evaluating Church numeral outputs: substitutions applied to large terms should share the
+# subtrees they do not change instead of copying them
+def bench_substitution_memory(outputs=("equal_test_1", "l6", "power_test_2"), max_eval_steps=40):
+    goviaji = load_quietly("systems/untyped_lambda/cn_tests.goviaji")
+    rules_db = goviaji.compiler.rules_db
+    tracemalloc.start()
+    for name in outputs:
+        tracemalloc.reset_peak()
+        start_memory = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        expr = goviaji.compiler.expressions_to_print[rules_db.constants[name]][0]
+        total_steps = 0
+        for i in range(max_eval_steps):
+            steps, expr = goviaji.eval_step(expr)
+            total_steps += steps
+            if expr is None:
+                break
+
+        elapsed = time.perf_counter() - start
+        current_memory, peak_memory = tracemalloc.get_traced_memory()
+        print("%s: %d proof steps in %.2f s, peak %.1f MB, retained %.1f MB" %
+              (name, total_steps, elapsed, (peak_memory - start_memory) / 1e6, (current_memory - start_memory) / 1e6))
+
+    tracemalloc.stop()
+
+
+# Proof steps and time spent evaluating outputs to values, with a value check and an eval step proof per step and
+# with an evaluation.Evaluator. Terms are not printed
+def bench_evaluation(file_name="systems/untyped_lambda/cn_tests.goviaji"):
+    for use_evaluator in [False, True]:
+        goviaji = load_quietly(file_name)
+        evaluator = Evaluator(goviaji)
+        start = time.perf_counter()
+        total_steps = 0
+        eval_steps = 0
+        for expr, src in goviaji.compiler.expressions_to_print.values():
+            if use_evaluator:
+                for steps, expr, state in evaluator.evaluate(expr):
+                    total_steps += steps
+                    eval_steps += state == "step"
+
+                continue
+
+            for s in range(goviaji.max_eval_steps):
+                steps, is_value = goviaji.value_check(expr)
+                total_steps += steps
+                if is_value:
+                    break
+
+                steps, expr = goviaji.eval_step(expr)
+                total_steps += steps
+                if expr is None:
+                    break
+
+                eval_steps += 1
+
+        print("%s: %d eval steps, %d proof steps in %.2f s" %
+              ("evaluator" if use_evaluator else "eval loop", eval_steps, total_steps, time.perf_counter() - start))
+        if use_evaluator:
+            print("\t%s" % ", ".join("%s %d" % item for item in evaluator.stats.items()))
+
+
+# Tokens per second of lexer.tokenize and of the character at a time lexer.tokenize_by_char on a generated file
+# made of copies of the rule, definition and print files of the systems
+def bench_lexer(copies=200):
+    sources = []
+    for file_name in sorted(glob.glob("systems/*/*.goviaji")):
+        with open(file_name) as f:
+            sources.append(f.read())
+
+    with tempfile.TemporaryDirectory() as directory:
+        file_name = os.path.join(directory, "generated.goviaji")
+        with open(file_name, "w") as f:
+            for i in range(copies):
+                f.write("\n".join(sources))
+
+        with open(file_name) as f:
+            text = f.read()
+
+    print("Lexer: %d lines, %.1f MB" % (text.count("\n") + 1, len(text) / 1e6))
+    for name, tokenize_function in [("tokenize_by_char", lexer.tokenize_by_char), ("tokenize", lexer.tokenize)]:
+        start = time.perf_counter()
+        num_tokens = len(tokenize_function(text).tokens)
+        elapsed = time.perf_counter() - start
+        print("\t%s: %d tokens in %.2f s, %.0f tokens/s" % (name, num_tokens, elapsed, num_tokens / elapsed))
+
+
+# Parsing and compiling must take linear time: the time per token stays the same as the files grow, both with many
+# rules and with rules that have many premises
+def bench_parser(sizes=(2000, 4000, 8000, 16000)):
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            file_name = os.path.join(directory, "generated_%d.goviaji" % size)
+            with open(file_name, "w") as f:
+                for i in range(size):
+                    f.write("rule r%d = p c%d X :- q X, q c%d\n" % (i, i, i))
+
+                f.write("rule long = long X :- %s\n" % ", ".join("q (c%d X)" % i for i in range(size)))
+
+            start = time.perf_counter()
+            tokens = lexer.tokenize(read_file(file_name))
+            num_tokens = len(tokens.tokens)
+            parse_instructions(tokens)
+            parse_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                Compiler().compile_file(file_name)
+            compile_time = time.perf_counter() - start
+            print("Parser: %d rules, %d tokens: parsed in %.2f s (%.2f us/token), compiled in %.2f s "
+                  "(%.2f us/token)" % (size + 1, num_tokens, parse_time, parse_time / num_tokens * 1e6, compile_time,
+                                       compile_time / num_tokens * 1e6))
+
+
+# Loading the compiled modules of the files must be faster than compiling them. The systems are copied to a
+# temporary folder, which gets the module cache
+def bench_module_cache(runs=20):
+    with tempfile.TemporaryDirectory() as directory:
+        shutil.copytree("systems", os.path.join(directory, "systems"))
+        file_name = os.path.join(directory, "systems/untyped_lambda/lambda_nb_tests.goviaji")
+        for name, use_module_cache in [("compiling", False), ("from the module cache", True)]:
+            with contextlib.redirect_stdout(io.StringIO()):
+                Compiler(use_module_cache).compile_file(file_name)
+
+            compile_time = finalize_time = 0
+            for i in range(runs):
+                compiler = Compiler(use_module_cache)
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    compiler.compile_file(file_name)
+                compile_time += time.perf_counter() - start
+
+                start = time.perf_counter()
+                compiler.finalize()
+                finalize_time += time.perf_counter() - start
+
+            print("Module cache: %s %s in %.1f ms, then finalize in %.1f ms" %
+                  (os.path.basename(file_name), name, compile_time / runs * 1e3, finalize_time / runs * 1e3))
+
+
+# Finalizing must take linear time in the number of definitions, here Church encodings each using a few earlier ones
+def bench_definitions(sizes=(100, 200, 400, 800)):
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            file_name = os.path.join(directory, "definitions_%d.goviaji" % size)
+            with open(file_name, "w") as f:
+                f.write("def tru = lambda T. (lambda F. T)\ndef fls = lambda T. (lambda F. F)\n"
+                        "def pair = lambda A. (lambda B. (lambda S. (S A B)))\n"
+                        "rule r = p X :- q X tru\n")
+                for i in range(size):
+                    f.write("def c%d = lambda F. (lambda X. (F (F X)))\n" % i)
+                    f.write("def p%d = pair c%d (pair tru c%d)\n" % (i, i, i // 2))
+
+            compiler = Compiler(use_module_cache=False)
+            with contextlib.redirect_stdout(io.StringIO()):
+                compiler.compile_file(file_name)
+
+            start = time.perf_counter()
+            compiler.finalize()
+            elapsed = time.perf_counter() - start
+            num_definitions = len(compiler.rules_db.definitions)
+            print("Definitions: %d defs finalized in %.1f ms (%.1f us/def)" %
+                  (num_definitions, elapsed * 1e3, elapsed / num_definitions * 1e6))
+
+
+benchmarks = {"rule_lookup": bench_rule_lookup, "substitution_memory": bench_substitution_memory,
+              "evaluation": bench_evaluation, "lexer": bench_lexer,
+              "parser": bench_parser, "module_cache": bench_module_cache,
+              "definitions": bench_definitions}
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or benchmarks.keys():
+        benchmarks[name]()
@@ -35,6 +35,9 @@ class RuleAtom(Rule):
 
 
 class RuleNewAtom(Rule):
+    # every call has to introduce a different atom
+    tabled = False
+
     def __init__(self, rules_db):
         Rule.__init__(self, [], expression_from_list([rules_db.add_constant_by_name("new_atom"), Variable("X")]),
                       rules_db.add_constant_by_name("new_atom_rule"), "(built-in)", rules_db)
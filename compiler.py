@@ -2,8 +2,10 @@ import lexer
 from goviaji_parser import read_file, parse_instructions, is_keyword, RuleKeywords, TokenList
 import rules
 from builtin_rules import add_builtins
-from expressions import Variable, expression_from_list
+from expressions import Variable, Application, expression_from_list
 import os
+import hashlib
+import marshal
 
 
 class CompilerError(Exception):
@@ -15,12 +17,122 @@ def is_constant(t, name=None):
            (name is None or t.string == name)
 
 
+# The instructions of a source file, as tuples of strings and ints that marshal can write:
+#   ("import", source, module path)
+#   ("def" or "print", source, name, expression)
+#   ("rule", source, name, conclusion, premises)
+# source being the text of the instruction. An expression is the preorder list of its nodes, 0 for an application
+# and 1 + 2 * i + is_variable for the i-th name of leaves
+class Module:
+    def __init__(self, leaves=None, instructions=None):
+        self.leaves = [] if leaves is None else leaves
+        self.instructions = [] if instructions is None else instructions
+        self.leaves_idx = {}
+
+    def leaf_code(self, name, is_variable):
+        key = name, is_variable
+        if key not in self.leaves_idx:
+            self.leaves_idx[key] = len(self.leaves)
+            self.leaves.append(name)
+
+        return 1 + 2 * self.leaves_idx[key] + is_variable
+
+    # the code of a parsed expression, like the expression compile_expression would build from it
+    def encode_expression(self, parsed_expression, tokens, code=None):
+        if code is None:
+            code = []
+            self.encode_expression(parsed_expression, tokens, code)
+            return tuple(code)
+
+        if isinstance(parsed_expression, lexer.Token):
+            if parsed_expression.type == lexer.TokenType.CONSTANT:
+                code.append(self.leaf_code(parsed_expression.string, False))
+            elif parsed_expression.type == lexer.TokenType.VARIABLE:
+                code.append(self.leaf_code(parsed_expression.string, True))
+            else:
+                raise CompilerError("Unknown token:\n" + tokens.part_until_here_str(parsed_expression.loc))
+
+            return
+
+        if isinstance(parsed_expression, TokenList):
+            parsed_expression = parsed_expression.elems
+
+        # expression_from_list nests the applications to the left
+        code.extend([0] * (len(parsed_expression) - 1))
+        for e in parsed_expression:
+            self.encode_expression(e, tokens, code)
+
+    # every variable leaf is a new Variable, as every variable token is for compile_expression
+    def decode_expression(self, code, rules_db):
+        stack = []
+        for c in reversed(code):
+            if c == 0:
+                left = stack.pop()
+                stack.append(Application(left, stack.pop()))
+            elif c % 2 == 0:
+                stack.append(Variable(self.leaves[(c - 1) // 2]))
+            else:
+                stack.append(rules_db.add_constant_by_name(self.leaves[(c - 1) // 2]))
+
+        return stack[0]
+
+
+# the compiled module of a source file is kept in this folder next to it, with the hash of the source it was
+# compiled from
+module_cache_folder = "__goviaji_cache__"
+module_cache_version = 1
+
+
+def module_cache_file(file_name):
+    return os.path.join(os.path.dirname(file_name), module_cache_folder, os.path.basename(file_name) + "c")
+
+
+def source_hash(source):
+    return hashlib.sha256(source.encode("utf-8")).digest()
+
+
+# the module compiled from the source with hash module_hash, or None if the cache has none
+def load_module(file_name, module_hash):
+    try:
+        with open(module_cache_file(file_name), "rb") as f:
+            version, cached_hash, leaves, instructions = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+
+    if version != module_cache_version or cached_hash != module_hash:
+        return None
+
+    return Module(leaves, instructions)
+
+
+# the file is replaced at once, as other processes may be reading it. A folder that cannot be written to only
+# leaves the module out of the cache
+def save_module(file_name, module_hash, module):
+    cache_file = module_cache_file(file_name)
+    temp_file = "%s.%d.tmp" % (cache_file, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(temp_file, "wb") as f:
+            marshal.dump((module_cache_version, module_hash, module.leaves, module.instructions), f)
+
+        os.replace(temp_file, cache_file)
+    except OSError:
+        pass
+
+
 class Compiler:
-    def __init__(self):
+    # with use_module_cache, the files are compiled into modules kept in module_cache_folder, and a file that has
+    # not changed since is neither tokenized nor parsed again
+    def __init__(self, use_module_cache=True):
+        self.use_module_cache = use_module_cache
         self.rules_db = rules.Rules()
         add_builtins(self.rules_db)
         self.expressions_to_print = {}
         self.compiled_files = set()
+        # the modules of the files compiled so far, and the modification time and source hash they were compiled
+        # from, by file name
+        self.modules = {}
+        self.file_states = {}
 
     @staticmethod
     def file_name_report_str(file_name, inclusion_path):
@@ -34,22 +146,54 @@ class Compiler:
     def compile_file(self, file_name, inclusion_path=None):
         file_name = os.path.abspath(file_name)
         self.compiled_files.add(file_name)
-        print("Compiling %s..." % os.path.basename(file_name))
         file_name_report = self.file_name_report_str(file_name, inclusion_path)
 
         if not os.path.exists(file_name):
+            print("Compiling %s..." % os.path.basename(file_name))
             raise CompilerError("cannot find file " + file_name_report)
 
+        # a module loaded from the cache is not reported
+        module = None
+        compiled = False
+        mtime = os.stat(file_name).st_mtime_ns
+        if file_name in self.modules and self.file_states[file_name][0] == mtime:
+            module = self.modules[file_name]
+        else:
+            source = read_file(file_name)
+            module_hash = source_hash(source)
+            if file_name in self.modules and self.file_states[file_name][1] == module_hash:
+                module = self.modules[file_name]
+            elif self.use_module_cache:
+                module = load_module(file_name, module_hash)
+
+            if module is None:
+                print("Compiling %s..." % os.path.basename(file_name))
+                module = self.compile_module(source, file_name_report)
+                if self.use_module_cache:
+                    save_module(file_name, module_hash, module)
+
+                compiled = True
+
+            self.modules[file_name] = module
+            self.file_states[file_name] = mtime, module_hash
+
+        self.add_module(module, file_name, inclusion_path)
+        if compiled:
+            print("Finished %s" % os.path.basename(file_name))
+
+    # the instructions of a file, with their expressions encoded by encode_expression, as a Module that does not
+    # depend on the other files nor on the rules compiled so far
+    def compile_module(self, source, file_name_report):
         try:
-            tokens = lexer.tokenize(read_file(file_name))
+            tokens = lexer.tokenize(source)
             compiled_instructions = parse_instructions(tokens)
         except lexer.RuleParseError as err:
             raise CompilerError("parse error in file %s:\n%s" % (file_name_report, err.args[0]))
 
+        module = Module()
         for instr in compiled_instructions:
-            definition_src = "file %s:\n%s" % (file_name_report, instr.source_str(tokens.lines))
+            instr_src = instr.source_str(tokens.lines)
             if is_keyword(instr.name, RuleKeywords.IMPORT):
-                cur_folder = os.path.dirname(file_name)
                 module_path = []
                 for t in (instr.expression.elems if isinstance(instr.expression, TokenList)
                           else [instr.expression]):
@@ -61,12 +205,7 @@ class Compiler:
                     else:
                         raise CompilerError("compound expression in imports:\n" + tokens.part_str(instr.loc, t.loc))
 
-                to_include = os.path.join(cur_folder, *module_path) + ".goviaji"
-                to_include = os.path.abspath(to_include)
-                if to_include in self.compiled_files:
-                    continue
-
-                self.compile_file(to_include, [file_name] if inclusion_path is None else ([file_name] + inclusion_path))
+                module.instructions.append((RuleKeywords.IMPORT.value, instr_src, tuple(module_path)))
             elif is_keyword(instr.name, RuleKeywords.RULE) or is_keyword(instr.name, RuleKeywords.DEF) or \
                     is_keyword(instr.name, RuleKeywords.PRINT):
                 if not isinstance(instr.expression, TokenList) or len(instr.expression.elems) < 3 or \
@@ -75,68 +214,91 @@ class Compiler:
                     raise CompilerError("syntax error in %s. Expected <name> = <expression> format:\n%s" %
                                         (instr.name.string, tokens.part_str(instr.loc, instr.expression.loc)))
 
-                name = self.compile_expression(instr.expression.elems[0], tokens)
+                name = module.encode_expression(instr.expression.elems[0], tokens)
                 expr_tokens = instr.expression.elems[2:]
                 if is_keyword(instr.name, RuleKeywords.DEF) or is_keyword(instr.name, RuleKeywords.PRINT):
-                    expr = self.compile_expression(expr_tokens, tokens)
-                    if is_keyword(instr.name, RuleKeywords.DEF):
-                        self.rules_db.add_definition(name, expr, definition_src)
-                    else:
-                        if name in self.expressions_to_print:
-                            raise CompilerError("duplicate print label %s:\nFirst occurrence:\n"
-                                                "%s\nDuplicate occurrence:\n%s" % (name.name,
-                                                                                   self.expressions_to_print[name][1],
-                                                                                   definition_src))
-
-                        self.expressions_to_print[name] = expr, definition_src
+                    module.instructions.append((instr.name.string, instr_src, name,
+                                                module.encode_expression(expr_tokens, tokens)))
                 else:
-                    conclusion_tokens = []
-                    while expr_tokens and not is_constant(expr_tokens[0], ":-"):
-                        conclusion_tokens.append(expr_tokens.pop(0))
+                    turnstile = 0
+                    while turnstile < len(expr_tokens) and not is_constant(expr_tokens[turnstile], ":-"):
+                        turnstile += 1
 
-                    if not conclusion_tokens:
+                    if turnstile == 0:
                         raise CompilerError("rule with an empty head:\n" + tokens.part_str(instr.loc))
 
-                    conclusion = self.compile_expression(conclusion_tokens, tokens)
+                    conclusion = module.encode_expression(expr_tokens[:turnstile], tokens)
                     premises = []
 
-                    if expr_tokens:
-                        expr_tokens.pop(0)
-                        while expr_tokens:
-                            premise_tokens = []
-                            while expr_tokens and not is_constant(expr_tokens[0], ","):
-                                if is_constant(expr_tokens[0], ":-"):
-                                    raise CompilerError("second turnstile in rule:\n" +
-                                                        tokens.part_str(instr.loc, expr_tokens[0].loc))
-
-                                premise_tokens.append(expr_tokens.pop(0))
-
-                            if not premise_tokens:
-                                raise CompilerError("empty premise in rule:\n" + tokens.part_str(instr.loc))
-
-                            premises.append(self.compile_expression(premise_tokens, tokens))
-                            if expr_tokens:
-                                expr_tokens.pop(0)
-
-                    added_rule = rules.Rule(premises, conclusion, name, definition_src, self.rules_db)
-                    self.rules_db.add_rule(added_rule)
-
-                    exprs = [added_rule.conclusion] + added_rule.premises
-                    var_counter = {}
-                    for e in exprs:
-                        e.count_leaves(var_counter)
-
-                    for leaf, count in var_counter.items():
-                        if count == 1 and leaf in added_rule.variables:
-                            for e in exprs[1:]:
-                                e_vars = e.collect_variables()
-                                if leaf in e_vars and len(e_vars) == 1:
-                                    print("Warning: rule %s has unbound variable %s:\n%s\nRepresentation: %s" %
-                                          (added_rule.name, leaf.name, definition_src, added_rule.to_str()))
+                    # the premises are the parts of expr_tokens between the commas after the turnstile
+                    premise_begin = turnstile + 1
+                    while premise_begin < len(expr_tokens):
+                        premise_end = premise_begin
+                        while premise_end < len(expr_tokens) and not is_constant(expr_tokens[premise_end], ","):
+                            if is_constant(expr_tokens[premise_end], ":-"):
+                                raise CompilerError("second turnstile in rule:\n" +
+                                                    tokens.part_str(instr.loc, expr_tokens[premise_end].loc))
+
+                            premise_end += 1
+
+                        if premise_end == premise_begin:
+                            raise CompilerError("empty premise in rule:\n" + tokens.part_str(instr.loc))
+
+                        premises.append(module.encode_expression(expr_tokens[premise_begin:premise_end], tokens))
+                        premise_begin = premise_end + 1
+
+                    module.instructions.append((RuleKeywords.RULE.value, instr_src, name, conclusion,
+                                                tuple(premises)))
             else:
                 raise CompilerError("unknown instruction type %s" % instr.name)
 
-        print("Finished %s" % os.path.basename(file_name))
+        return module
+
+    # compiles the imports of the module and adds its rules, definitions and outputs
+    def add_module(self, module, file_name, inclusion_path):
+        file_name_report = self.file_name_report_str(file_name, inclusion_path)
+        for instr in module.instructions:
+            definition_src = "file %s:\n%s" % (file_name_report, instr[1])
+            if instr[0] == RuleKeywords.IMPORT.value:
+                to_include = os.path.join(os.path.dirname(file_name), *instr[2]) + ".goviaji"
+                to_include = os.path.abspath(to_include)
+                if to_include in self.compiled_files:
+                    continue
+
+                self.compile_file(to_include, [file_name] if inclusion_path is None else ([file_name] + inclusion_path))
+                continue
+
+            name = module.decode_expression(instr[2], self.rules_db)
+            if instr[0] == RuleKeywords.DEF.value:
+                self.rules_db.add_definition(name, module.decode_expression(instr[3], self.rules_db), definition_src)
+            elif instr[0] == RuleKeywords.PRINT.value:
+                if name in self.expressions_to_print:
+                    raise CompilerError("duplicate print label %s:\nFirst occurrence:\n"
+                                        "%s\nDuplicate occurrence:\n%s" % (name.name,
+                                                                           self.expressions_to_print[name][1],
+                                                                           definition_src))
+
+                self.expressions_to_print[name] = module.decode_expression(instr[3], self.rules_db), definition_src
+            else:
+                conclusion = module.decode_expression(instr[3], self.rules_db)
+                premises = [module.decode_expression(p, self.rules_db) for p in instr[4]]
+                self.add_rule(rules.Rule(premises, conclusion, name, definition_src, self.rules_db))
+
+    def add_rule(self, added_rule):
+        self.rules_db.add_rule(added_rule)
+
+        exprs = [added_rule.conclusion] + added_rule.premises
+        var_counter = {}
+        for e in exprs:
+            e.count_leaves(var_counter)
+
+        for leaf, count in var_counter.items():
+            if count == 1 and leaf in added_rule.variables:
+                for e in exprs[1:]:
+                    e_vars = e.collect_variables()
+                    if leaf in e_vars and len(e_vars) == 1:
+                        print("Warning: rule %s has unbound variable %s:\n%s\nRepresentation: %s" %
+                              (added_rule.name, leaf.name, added_rule.definition_src, added_rule.to_str()))
 
     def compile_expression(self, parsed_expression, tokens):
         if isinstance(parsed_expression, lexer.Token):
@@ -153,6 +315,49 @@ class Compiler:
 
         return expression_from_list([self.compile_expression(e, tokens) for e in parsed_expression])
 
+    # the compiled files that changed since they were compiled, in content and not only in modification time, or
+    # that cannot be read any more. A file that cannot be read is only reported once
+    def changed_files(self):
+        changed = []
+        for file_name in sorted(self.compiled_files):
+            try:
+                mtime = os.stat(file_name).st_mtime_ns
+                if file_name in self.file_states and self.file_states[file_name][0] == mtime:
+                    continue
+
+                module_hash = source_hash(read_file(file_name))
+            except OSError:
+                if self.file_states.pop(file_name, None) is not None:
+                    changed.append(file_name)
+
+                continue
+
+            if file_name in self.file_states and self.file_states[file_name][1] == module_hash:
+                self.file_states[file_name] = mtime, module_hash
+            else:
+                changed.append(file_name)
+
+        return changed
+
+    # compiles file_name again into the same rules database, which keeps its constants. The modules of the files
+    # that have not changed are reused, so only the changed files are tokenized and parsed again. If the compilation
+    # fails, the rules and the states of the files are those from before, so the changed files are compiled again
+    # by the next recompile
+    def recompile(self, file_name):
+        saved = (self.rules_db.rules_state(), self.expressions_to_print, self.compiled_files, dict(self.modules),
+                 dict(self.file_states))
+        self.rules_db.clear()
+        add_builtins(self.rules_db)
+        self.expressions_to_print = {}
+        self.compiled_files = set()
+        try:
+            self.compile_file(file_name)
+            self.finalize()
+        except (CompilerError, rules.RulesError):
+            rules_state, self.expressions_to_print, self.compiled_files, self.modules, self.file_states = saved
+            self.rules_db.restore(rules_state)
+            raise
+
     def finalize(self):
         self.rules_db.flatten_definitions()
         for name, (expr, src) in self.expressions_to_print.items():
@@ -0,0 +1,99 @@
+from expressions import Variable, Application
+
+
+# Rule heads are stored in a trie over their preorder traversal. An application contributes application_key
+# followed by its two children, a variable contributes any_term_key and a constant is its own key
+application_key = "@"
+any_term_key = "*"
+
+
+def term_key(expr):
+    if isinstance(expr, Application):
+        return application_key
+
+    if isinstance(expr, Variable):
+        return any_term_key
+
+    return expr
+
+
+class DiscriminationTreeNode:
+    def __init__(self):
+        self.children = {}
+        self.entries = []
+
+
+class DiscriminationTree:
+    def __init__(self):
+        self.root = DiscriminationTreeNode()
+        self.size = 0
+        self.skip_cache = {}
+
+    def add(self, expr, value):
+        node = self.root
+        to_visit = [expr]
+        while to_visit:
+            e = to_visit.pop()
+            key = term_key(e)
+            if key is application_key:
+                to_visit.append(e.elems[1])
+                to_visit.append(e.elems[0])
+
+            if key not in node.children:
+                node.children[key] = DiscriminationTreeNode()
+
+            node = node.children[key]
+
+        node.entries.append((self.size, value))
+        self.size += 1
+        self.skip_cache.clear()
+
+    # nodes reached from node by consuming exactly one stored subterm
+    def skip_term(self, node):
+        if node not in self.skip_cache:
+            reached = []
+            to_visit = [(node, 1)]
+            while to_visit:
+                n, terms_left = to_visit.pop()
+                if terms_left == 0:
+                    reached.append(n)
+                    continue
+
+                for key, child in n.children.items():
+                    to_visit.append((child, terms_left + 1 if key is application_key else terms_left - 1))
+
+            self.skip_cache[node] = reached
+
+        return self.skip_cache[node]
+
+    # returns the values of all stored expressions that may unify with expr, in the order they were added.
+    # Shared variables are not taken into account, so unification can still fail on the returned entries
+    def find_unifiable(self, expr):
+        found = []
+        # the terms left to match are kept as a linked list of (term, rest) pairs shared between branches
+        to_visit = [(self.root, (expr, None))]
+        while to_visit:
+            node, terms = to_visit.pop()
+            if terms is None:
+                found.extend(node.entries)
+                continue
+
+            e, rest = terms
+            if isinstance(e, Variable):
+                for n in self.skip_term(node):
+                    to_visit.append((n, rest))
+
+                continue
+
+            if any_term_key in node.children:
+                to_visit.append((node.children[any_term_key], rest))
+
+            key = term_key(e)
+            if key in node.children:
+                if key is application_key:
+                    to_visit.append((node.children[key], (e.elems[0], (e.elems[1], rest))))
+                else:
+                    to_visit.append((node.children[key], rest))
+
+        found.sort(key=lambda entry: entry[0])
+        return [value for _, value in found]
@@ -0,0 +1,153 @@
+from expressions import Application, expression_from_list
+from proof_cache import encode_answer, decode_answer
+
+
+# the path from the root of expr to one of its subterms, as the indices of the children to follow
+def get_subterm(expr, position):
+    for i in position:
+        expr = expr.elems[i]
+
+    return expr
+
+
+def replace_subterm(expr, position, new_subterm):
+    if not position:
+        return new_subterm
+
+    elems = list(expr.elems)
+    elems[position[0]] = replace_subterm(elems[position[0]], position[1:], new_subterm)
+    return Application(*elems)
+
+
+# the position of the smallest subterm of expr containing all the differences between expr and new_expr, or None
+# if they are the same term
+def changed_position(expr, new_expr):
+    if expr is new_expr:
+        return None
+
+    position = []
+    while isinstance(expr, Application) and isinstance(new_expr, Application):
+        changed = [i for i in range(2) if expr.elems[i] is not new_expr.elems[i]]
+        if len(changed) != 1:
+            break
+
+        position.append(changed[0])
+        expr = expr.elems[changed[0]]
+        new_expr = new_expr.elems[changed[0]]
+
+    return tuple(position)
+
+
+# Evaluates terms one eval step after the other like the eval loop of run_output, reusing work between the steps:
+# - the result of every term and subterm evaluated is kept in memo, keyed by its hash (so a variant of the term
+#   gets the same result, renamed to its own generated constants), and a term seen before is not proven again;
+# - a step usually happens at or just above the position changed by the previous one, so the subterms there are
+#   evaluated first, and the step of the whole term is then checked with a ground proof, in which the premises
+#   about the rest of the term are already in the prover cache. The full proof is the fallback;
+# - the value check is only proven when the term has no eval step or evaluates to itself (as values do in a
+#   big-step semantics), so a step usually costs a single proof. This assumes that a value cannot evaluate to
+#   another term.
+# A step found at the changed position is the first answer of the full proof when eval is deterministic
+class Evaluator:
+    def __init__(self, goviaji):
+        self.goviaji = goviaji
+        self.rules_db = goviaji.compiler.rules_db
+        # term hash -> encoded result, or None for a term without an eval step
+        self.memo = {}
+        self.stats = {"memo_hits": 0, "local_steps": 0, "full_proofs": 0}
+
+    def memo_lookup(self, expr):
+        encoded = self.memo[expr.get_hash()]
+        return None if encoded is None else decode_answer(expr, encoded, self.rules_db)
+
+    def memo_store(self, expr, result):
+        self.memo[expr.get_hash()] = None if result is None else encode_answer(expr, result)
+
+    # the result of an eval step of expr, from the memo or from a full proof
+    def eval_term(self, expr):
+        if expr.get_hash() in self.memo:
+            self.stats["memo_hits"] += 1
+            return 0, self.memo_lookup(expr)
+
+        self.stats["full_proofs"] += 1
+        steps, result = self.goviaji.eval_step(expr)
+        # a proof stopped by the steps budget does not show that expr has no eval step
+        if result is not None or steps < self.goviaji.proof_steps_budget:
+            self.memo_store(expr, result)
+
+        if result is not None:
+            self.mark_proven(expr, result)
+
+        return steps, result
+
+    # the ground goal of the step is recorded in the prover cache, so that checking a step of a term containing
+    # expr does not prove it again
+    def mark_proven(self, expr, result):
+        self.goviaji.prover_cache[self.eval_goal(expr, result).get_hash()] = True
+
+    def eval_goal(self, expr, result):
+        return expression_from_list([self.goviaji.eval_predicate_name, expr, result])
+
+    # the step of expr found below the root, at position or one of its ancestors
+    def local_step(self, expr, position):
+        total_steps = 0
+        while position:
+            steps, sub_result = self.eval_term(get_subterm(expr, position))
+            total_steps += steps
+            if sub_result is not None:
+                candidate = replace_subterm(expr, position, sub_result)
+                steps, subs = next(self.goviaji.prove([self.eval_goal(expr, candidate)], first_answer=True))
+                total_steps += steps
+                if subs is not None:
+                    return total_steps, candidate
+
+                # the subterm cannot be reduced in this context, nor can its ancestors below the redex
+                return total_steps, None
+
+            position = position[:-1]
+
+        return total_steps, None
+
+    # returns the number of proof steps and the result of an eval step of expr, or None if it has none.
+    # position is where the previous step changed the term
+    def step(self, expr, position=None):
+        if expr.get_hash() in self.memo:
+            self.stats["memo_hits"] += 1
+            return 0, self.memo_lookup(expr)
+
+        total_steps = 0
+        if position:
+            total_steps, result = self.local_step(expr, position)
+            if result is not None:
+                self.stats["local_steps"] += 1
+                self.memo_store(expr, result)
+                return total_steps, result
+
+        steps, result = self.eval_term(expr)
+        return total_steps + steps, result
+
+    # yields (proof steps, term, state) for the term and for the result of every eval step, state being "step" for
+    # a term with an eval step, "value" for a value, "stuck" for a term that is neither and "stopped" for the term
+    # reached after max_steps steps (max_eval_steps of the Goviaji by default)
+    def evaluate(self, expr, max_steps=None):
+        if max_steps is None:
+            max_steps = self.goviaji.max_eval_steps
+
+        position = None
+        for s in range(max_steps):
+            steps, result = self.step(expr, position)
+            if result is None or result is expr:
+                is_value = False
+                if self.goviaji.value_predicate_name:
+                    value_steps, is_value = self.goviaji.value_check(expr)
+                    steps += value_steps
+
+                if is_value or result is None:
+                    yield steps, expr, "value" if is_value else "stuck"
+                    return
+
+            yield steps, expr, "step"
+            position = changed_position(expr, result)
+            expr = result
+
+        yield 0, expr, "stopped"
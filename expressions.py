@@ -1,5 +1,6 @@
 from substitution import Substitution
 import hashes
+import weakref
 
 
 class Expression:
@@ -14,9 +15,16 @@ class Expression:
         else:
             return self.name
 
+    # subtrees left unchanged by transform are returned as they are instead of being rebuilt
     def transform_leaves(self, transform):
         if isinstance(self, Application):
-            return Application(*(e.transform_leaves(transform) for e in self.elems))
+            left, right = self.elems
+            new_left = left.transform_leaves(transform)
+            new_right = right.transform_leaves(transform)
+            if new_left is left and new_right is right:
+                return self
+
+            return Application(new_left, new_right)
 
         return transform(self)
 
@@ -24,12 +32,34 @@ class Expression:
         r = transform(self)
         if r is None:
             if isinstance(self, Application):
-                r = Application(*(e.transform_nodes(transform) for e in self.elems))
+                left, right = self.elems
+                new_left = left.transform_nodes(transform)
+                new_right = right.transform_nodes(transform)
+                r = self if new_left is left and new_right is right else Application(new_left, new_right)
             else:
                 r = self
 
         return r
 
+    # replaces the variables that are keys of replacements. Subtrees without any of them are not visited, and a
+    # subtree occurring several times is only visited once
+    def replace_variables(self, replacements, replaced=None):
+        if replacements.keys().isdisjoint(self.variables):
+            return self
+
+        if isinstance(self, Variable):
+            return replacements[self]
+
+        if replaced is None:
+            replaced = {}
+        elif self in replaced:
+            return replaced[self]
+
+        result = Application(self.elems[0].replace_variables(replacements, replaced),
+                             self.elems[1].replace_variables(replacements, replaced))
+        replaced[self] = result
+        return result
+
     def any_leaf(self, predicate):
         if isinstance(self, Application):
             return any(e.any_leaf(predicate) for e in self.elems)
@@ -37,9 +67,12 @@ class Expression:
         return predicate(self)
 
     def is_ground(self):
-        return not self.any_leaf(lambda l: isinstance(l, Variable))
+        return not self.variables
 
     def contains_leaf(self, to_find):
+        if isinstance(to_find, Variable):
+            return to_find in self.variables
+
         return self.any_leaf(lambda l: l is to_find)
 
     def for_all_leaves(self, process):
@@ -51,13 +84,9 @@ class Expression:
 
     def collect_variables(self, accum_vars=None):
         if accum_vars is None:
-            accum_vars = set()
+            return set(self.variables)
 
-        def var_accumulator(leaf):
-            if isinstance(leaf, Variable):
-                accum_vars.add(leaf)
-
-        self.for_all_leaves(var_accumulator)
+        accum_vars.update(self.variables)
         return accum_vars
 
     def collect_constants(self, accum_consts=None):
@@ -85,53 +114,36 @@ class Expression:
         return counter
 
     def unify(self, expr):
-        subs = Substitution()
-        eqs = [(self, expr)]
-        while eqs:
-            lhs, rhs = eqs.pop()
-            if lhs is rhs:
-                continue
-            elif isinstance(lhs, Application) and isinstance(rhs, Application):
-                eqs.extend(zip(lhs.elems, rhs.elems))
-            elif isinstance(lhs, Variable) or isinstance(rhs, Variable):
-                if not isinstance(lhs, Variable):
-                    lhs, rhs = rhs, lhs
-
-                if isinstance(rhs, Variable) or not rhs.contains_leaf(lhs):
-                    add_subs = Substitution()
-                    add_subs.replace(lhs, rhs)
-                    subs.compose(add_subs)
-                    eqs = [(add_subs.apply(lhs), add_subs.apply(rhs)) for lhs, rhs in eqs]
-                else:
-                    return None
-            else:
-                return None
+        bindings = Bindings()
+        if not bindings.unify(self, expr):
+            return None
 
-        return subs
+        return bindings.to_substitution()
 
+    # applications are hash-consed, so structurally equal trees are the same object
     def tree_equal(self, e):
-        if type(self) != type(e):
-            return False
-
-        if isinstance(self, Application):
-            return self.elems[0].tree_equal(e.elems[0]) and self.elems[1].tree_equal(e.elems[1])
-
         return self is e
 
     def __repr__(self):
         return self.to_str()
 
     def get_hash(self):
-        variables_idx = {}
+        if self.variant_hash is None:
+            variables_idx = {}
+            self.variant_hash = self.calc_hash(variables_idx)
 
-        return self.calc_hash(variables_idx)
+        return self.variant_hash
 
 
 class Constant(Expression):
     def __init__(self, name, generated=False):
         self.name = name
-        self.hash = hashes.new_hash()
+        self.hash = hashes.new_hash(name)
         self.generated = generated
+        self.size = 1
+        self.variables = no_variables
+        self.closed = not generated
+        self.variant_hash = None
 
     def collect_level(self):
         return [self]
@@ -149,6 +161,10 @@ class Constant(Expression):
 class Variable(Expression):
     def __init__(self, name):
         self.name = name
+        self.size = 1
+        self.variables = frozenset([self])
+        self.closed = False
+        self.variant_hash = None
 
     def collect_level(self):
         return [self]
@@ -160,9 +176,37 @@ class Variable(Expression):
         return hashes.get_hash_for_idx(variables_idx[self], 0)
 
 
+# structurally identical applications are shared: Application(l, r) returns the existing node for the same
+# (l, r) pair as long as it is alive. Leaves are already unique objects, so a pair of children identifies a tree
+interned_applications = weakref.WeakValueDictionary()
+
+
 class Application(Expression):
-    def __init__(self, left, right):
-        self.elems = left, right
+    def __new__(cls, left, right):
+        elems = left, right
+        app = interned_applications.get(elems)
+        if app is not None:
+            return app
+
+        app = Expression.__new__(cls)
+        app.elems = elems
+        app.size = left.size + right.size
+
+        # a closed subtree has neither variables nor generated constants, so its hash does not depend on the
+        # numbering of the enclosing term and can be computed once
+        app.closed = left.closed and right.closed
+        app.hash = hashes.combine_hashes(left.hash, right.hash) if app.closed else None
+        app.variant_hash = None
+
+        if not right.variables:
+            app.variables = left.variables
+        elif not left.variables:
+            app.variables = right.variables
+        else:
+            app.variables = left.variables | right.variables
+
+        interned_applications[elems] = app
+        return app
 
     def __iter__(self):
         return self.elems
@@ -173,12 +217,122 @@ class Application(Expression):
         return left
 
     def calc_hash(self, variables_idx):
+        if self.closed:
+            return self.hash
+
         return hashes.combine_hashes(self.elems[0].calc_hash(variables_idx), self.elems[1].calc_hash(variables_idx))
 
 
+no_variables = frozenset()
+
+
+# variant hash of a sequence of expressions. Variables and generated constants are numbered across the whole
+# sequence, so two sequences get the same hash when one can be renamed into the other
+def get_list_hash(exprs):
+    variables_idx = {}
+    h = 0
+    for e in exprs:
+        h = hashes.combine_hashes(h, e.calc_hash(variables_idx))
+
+    return h
+
+
 # inverse of collect_level
 def expression_from_list(l):
-    if len(l) == 1:
-        return l[0]
+    expr = l[0]
+    for e in l[1:]:
+        expr = Application(expr, e)
 
-    return expression_from_list([Application(l[0], l[1])] + l[2:])
+    return expr
+
+
+# Variable bindings built during unification. A variable is bound either to another variable or to a term whose
+# variables may be bound themselves (a triangular substitution), so binding a variable never rewrites the terms
+# collected so far. Chains of bound variables are compressed on lookup, and the bindings are resolved into a
+# Substitution only once unification has succeeded
+class Bindings:
+    def __init__(self):
+        self.bound = {}
+
+    def find(self, expr):
+        if not isinstance(expr, Variable) or expr not in self.bound:
+            return expr
+
+        root = self.bound[expr]
+        while isinstance(root, Variable) and root in self.bound:
+            root = self.bound[root]
+
+        while expr is not root and isinstance(expr, Variable) and expr in self.bound:
+            self.bound[expr], expr = root, self.bound[expr]
+
+        return root
+
+    # the occurs check only walks the cached variable sets of the terms reachable through the bindings
+    def occurs(self, var, expr):
+        to_check = [expr]
+        checked = set()
+        while to_check:
+            for v in to_check.pop().variables:
+                if v is var:
+                    return True
+
+                if v in self.bound and v not in checked:
+                    checked.add(v)
+                    to_check.append(self.bound[v])
+
+        return False
+
+    def bind(self, var, expr):
+        if not isinstance(expr, Variable) and self.occurs(var, expr):
+            return False
+
+        self.bound[var] = expr
+        return True
+
+    def unify(self, lhs, rhs):
+        eqs = [(lhs, rhs)]
+        while eqs:
+            lhs, rhs = eqs.pop()
+            lhs = self.find(lhs)
+            rhs = self.find(rhs)
+            if lhs is rhs:
+                continue
+            elif isinstance(lhs, Variable):
+                if not self.bind(lhs, rhs):
+                    return False
+            elif isinstance(rhs, Variable):
+                if not self.bind(rhs, lhs):
+                    return False
+            elif isinstance(lhs, Application) and isinstance(rhs, Application):
+                # applications are hash-consed, so different ground terms never unify
+                if not lhs.variables and not rhs.variables:
+                    return False
+
+                eqs.extend(zip(lhs.elems, rhs.elems))
+            else:
+                return False
+
+        return True
+
+    def resolve(self, expr, resolved):
+        if isinstance(expr, Variable):
+            if expr not in self.bound:
+                return expr
+
+            if expr not in resolved:
+                resolved[expr] = self.resolve(self.bound[expr], resolved)
+
+            return resolved[expr]
+
+        if isinstance(expr, Application) and any(v in self.bound for v in expr.variables):
+            return Application(self.resolve(expr.elems[0], resolved), self.resolve(expr.elems[1], resolved))
+
+        return expr
+
+    def to_substitution(self):
+        subs = Substitution()
+        resolved = {}
+        for var in self.bound:
+            subs.replace(var, self.resolve(var, resolved))
+
+        return subs
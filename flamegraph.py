@@ -0,0 +1,26 @@
+# Proof stacks in the collapsed format read by flamegraph tools: one line per stack, with its frames from the
+# outermost to the innermost separated by ";" and followed by the number of samples. The frames are the names of
+# the rules whose premises were being proven when a goal was expanded, below a root frame
+class StackRecorder:
+    def __init__(self, root_frame="proof", sample_every=1):
+        self.root_frame = root_frame
+        self.sample_every = sample_every
+        self.goals_expanded = 0
+        self.counts = {}
+
+    # rule_names goes from the outermost rule to the innermost one
+    def record(self, rule_names):
+        self.goals_expanded += 1
+        if self.goals_expanded % self.sample_every:
+            return
+
+        stack = tuple(rule_names)
+        self.counts[stack] = self.counts.get(stack, 0) + 1
+
+    def to_collapsed(self):
+        return "".join("%s %d\n" % (";".join((self.root_frame,) + stack), count)
+                       for stack, count in sorted(self.counts.items()))
+
+    def write(self, file_name):
+        with open(file_name, "w") as f:
+            f.write(self.to_collapsed())
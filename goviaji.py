@@ -1,20 +1,60 @@
+import sys
 from sys import stderr
+import time
+import os
+import io
+import multiprocessing
+import argparse
 from compiler import Compiler, CompilerError
 import rules
 import prover
-from expressions import expression_from_list
+import tabling
+import trail_prover
+import or_parallel
+from proof_cache import ProofCache, ProofStore
+from profiler import ProofProfiler
+from flamegraph import StackRecorder
+from evaluation import Evaluator
+from expressions import Variable, expression_from_list, get_list_hash
 from lexer import tokenize
 from goviaji_parser import parse_expression
 
 
 class Goviaji:
-    def __init__(self, file_name):
+    # proof_cache_file is an sqlite file where proof results are kept between runs. use_module_cache keeps the
+    # compiled files in a cache folder next to them (see Compiler)
+    def __init__(self, file_name, proof_cache_file=None, use_module_cache=True):
         self.proof_steps_budget = 10000
         self.max_eval_steps = 1000
-        self.prover_cache = {}
-        self.compiler = Compiler()
+        # one of prover.search_strategies, "tabled" for tabled resolution or "trail" for depth-first search with
+        # destructive bindings
+        self.search_strategy = "dfs"
+        # cut proof branches that repeat the goals of one of their ancestors
+        self.loop_check = False
+        self.loop_stats = {"loop_checks": 0, "branches_pruned": 0}
+        # with more than one job, the top-level branches of the proofs of prover.search_strategies that only need
+        # their first answer are explored by that many processes, giving the first answer found by any of them
+        # unless or_parallel_deterministic is set. The processes are kept in or_parallel_pool until close
+        self.or_parallel_jobs = 1
+        self.or_parallel_deterministic = False
+        self.or_parallel_pool = None
+        # a profiler.ProofProfiler collecting counters per rule and predicate, or None
+        self.profiler = None
+        # a flamegraph.StackRecorder collecting the rule stacks of the proofs, or None
+        self.stack_recorder = None
+        self.answer_tables = {}
+        # set while a query is suspended between its answers, when no other proof can be started (see query)
+        self.query_in_progress = False
+        # an evaluation.Evaluator used by run_output instead of a value check and an eval step proof per step, or None
+        self.evaluator = None
+        self.file_name = file_name
+        self.compiler = Compiler(use_module_cache)
         self.compiler.compile_file(file_name)
         self.compiler.finalize()
+        # the rules as they were last compiled successfully, to tell what changed once they are compiled again
+        self.rules_snapshot = self.compiler.rules_db.snapshot()
+        proof_store = ProofStore(proof_cache_file, self.compiler.rules_db) if proof_cache_file else None
+        self.prover_cache = ProofCache(max_entries=100000, store=proof_store)
         self.syntax_predicate_name = self.compiler.rules_db.constants["term"] \
             if "term" in self.compiler.rules_db.constants else None
         
@@ -36,10 +76,120 @@ class Goviaji:
               (len(self.compiler.expressions_to_print),
                ", ".join(rn.name for rn in self.compiler.expressions_to_print.keys())))
 
+    # steps_budget defaults to proof_steps_budget. deadline (see prover.prove_dfs) is only checked by the strategies
+    # of prover.search_strategies run in this process and by "trail", which supports none of loop_check, profiler
+    # and stack_recorder: proving with one of them set raises ValueError. With first_answer, the caller takes at most
+    # one answer, which lets the proof be OR-parallel (see or_parallel_jobs)
+    def prove(self, proposition, steps_budget=None, deadline=None, first_answer=False):
+        if self.query_in_progress:
+            raise RuntimeError("cannot start a proof while a query is in progress: exhaust or close the query first")
+
+        if steps_budget is None:
+            steps_budget = self.proof_steps_budget
+
+        if self.search_strategy == "tabled":
+            return tabling.prove_tabled(self.compiler.rules_db, proposition, steps_budget, self.answer_tables)
+
+        self.prover_cache.start_proof()
+        if self.search_strategy == "trail":
+            if self.loop_check or self.profiler is not None or self.stack_recorder is not None:
+                raise ValueError("the trail strategy does not support loop checks, profiles or flamegraphs")
+
+            return trail_prover.prove_trail(self.compiler.rules_db, proposition, steps_budget, self.prover_cache,
+                                            goals_by_hash=self.prover_cache.goals, deadline=deadline)
+
+        if first_answer and self.or_parallel_jobs > 1 and self.profiler is None and self.stack_recorder is None \
+                and deadline is None and not multiprocessing.current_process().daemon:
+            if self.or_parallel_pool is not None and self.or_parallel_pool.jobs != self.or_parallel_jobs:
+                self.close()
+
+            if self.or_parallel_pool is None:
+                self.or_parallel_pool = or_parallel.OrParallelPool(self.compiler.rules_db, self.prover_cache,
+                                                                   self.or_parallel_jobs)
+
+            return self.or_parallel_pool.prove(proposition, steps_budget, search_strategy=self.search_strategy,
+                                               loop_check=self.loop_check, loop_stats=self.loop_stats,
+                                               deterministic=self.or_parallel_deterministic)
+
+        return prover.prove_dfs(self.compiler.rules_db, proposition, steps_budget, self.prover_cache,
+                                search_strategy=self.search_strategy, loop_check=self.loop_check,
+                                loop_stats=self.loop_stats, profiler=self.profiler,
+                                stack_recorder=self.stack_recorder, deadline=deadline,
+                                goals_by_hash=self.prover_cache.goals)
+
+    # stops the processes of the OR-parallel proofs
+    def close(self):
+        if self.or_parallel_pool is not None:
+            self.or_parallel_pool.close()
+            self.or_parallel_pool = None
+
+    # compiles the files that changed since they were compiled again (see Compiler.recompile) and returns them with
+    # the rules.RulesChange, or an empty list and None if no file changed. The results of the prover cache and the
+    # answer tables are kept unless the change affects their goals, which is only known for the goals recorded in
+    # prover_cache.goals: set it to a dict to keep results across reloads. Errors of the compilation are raised with
+    # the rules left as they were, and the next reload compiles the changed files again
+    def reload(self):
+        changed_files = self.compiler.changed_files()
+        if not changed_files:
+            return changed_files, None
+
+        self.compiler.recompile(self.file_name)
+        # the processes of the OR-parallel proofs have a copy of the previous rules
+        self.close()
+        rules_db = self.compiler.rules_db
+        change = rules.RulesChange(rules_db, self.rules_snapshot)
+        self.rules_snapshot = rules_db.snapshot()
+        if change.affected:
+            self.prover_cache.invalidate(lambda goal: goal is not None and not change.affects(goal))
+            self.answer_tables = {h: table for h, table in self.answer_tables.items()
+                                  if not change.affects(table.goal)}
+            if self.evaluator is not None:
+                self.evaluator = Evaluator(self)
+
+        if self.prover_cache.store is not None:
+            self.prover_cache.store.update_fingerprint()
+
+        return changed_files, change
+
+    # yields the answers to the goals lazily, as substitutions of the variables of the goals (see
+    # str_to_proposition), leaving out answers that are variants of earlier ones. goals is a goal string or a list
+    # of them. The search stops after max_answers answers, steps_budget proof steps or time_limit seconds, whichever
+    # comes first. The time limit interrupts the search inside a proof only for prover.search_strategies and "trail";
+    # "tabled" checks it between answers.
+    # The proof of a query shares prover_cache with the other proofs, so no other proof can be started, nor another
+    # query iterated, until this one is exhausted or closed: starting one raises RuntimeError
+    def query(self, goals, max_answers=None, steps_budget=None, time_limit=None):
+        if isinstance(goals, str):
+            goals = [goals]
+
+        proposition, variables = self.str_to_proposition(goals)
+        query_vars = list(variables.values())
+        deadline = None if time_limit is None else time.perf_counter() + time_limit
+        answer_hashes = set()
+        answers = self.prove(proposition, steps_budget, deadline)
+        self.query_in_progress = True
+        try:
+            for steps, subs in answers:
+                if subs is None:
+                    return
+
+                h = get_list_hash([subs.replacements.get(var, var) for var in query_vars])
+                if h not in answer_hashes:
+                    answer_hashes.add(h)
+                    yield subs
+                    if max_answers is not None and len(answer_hashes) >= max_answers:
+                        return
+
+                if deadline is not None and time.perf_counter() > deadline:
+                    return
+        except prover.ProofTimeout:
+            return
+        finally:
+            self.query_in_progress = False
+
     def property_check(self, expr, property_name):
         test_proposition = [expression_from_list([property_name, expr])]
-        steps, subs = next(prover.prove_dfs(self.compiler.rules_db, test_proposition, self.proof_steps_budget,
-                                            self.prover_cache))
+        steps, subs = next(self.prove(test_proposition, first_answer=True))
         return steps, subs is not None
     
     def syntax_check(self, expr):
@@ -50,11 +200,22 @@ class Goviaji:
 
     def eval_step(self, expr):
         target_var = self.compiler.rules_db.introduce_variable()
-        eval_proposition = [expression_from_list([self.eval_predicate_name, expr, target_var])]
-        steps, subs = next(prover.prove_dfs(self.compiler.rules_db, eval_proposition, self.proof_steps_budget,
-                                            self.prover_cache))
+        eval_goal = expression_from_list([self.eval_predicate_name, expr, target_var])
+        proof_store = self.prover_cache.store
+        if proof_store is not None:
+            stored_result = proof_store.get_answer(eval_goal, self.search_strategy, self.loop_check)
+            if stored_result is not None:
+                return 0, stored_result
 
-        return steps, subs.replacements[target_var] if subs is not None else subs
+        steps, subs = next(self.prove([eval_goal], first_answer=True))
+        if subs is None:
+            return steps, None
+
+        # any branch may give the first answer of a proof that is OR-parallel but not deterministic
+        if proof_store is not None and (self.or_parallel_jobs == 1 or self.or_parallel_deterministic):
+            proof_store.put_answer(eval_goal, self.search_strategy, self.loop_check, subs.replacements[target_var])
+
+        return steps, subs.replacements[target_var]
 
     def steps_report(self, num_steps):
         return "[%d steps%s]" % (num_steps, " - stopped" * (num_steps >= self.proof_steps_budget))
@@ -64,11 +225,131 @@ class Goviaji:
         parsed_expr = parse_expression(tokens)
         return self.compiler.compile_expression(parsed_expr, tokens)
 
+    # the goals share one variable per variable name, which keeps its name. Returns the goals and their variables
+    # by name
+    def str_to_proposition(self, goal_strings):
+        variables = {}
+
+        def merge_variable(leaf):
+            if isinstance(leaf, Variable):
+                return variables.setdefault(leaf.name, leaf)
+
+            return leaf
+
+        proposition = [self.compiler.rules_db.instantiate_definitions(self.str_to_expression(s)).transform_leaves(
+            merge_variable) for s in goal_strings]
+        return proposition, variables
+
+
+# prints the checks and the evaluation of an output to out
+def run_output(goviaji, name, expr, out):
+    print("Output %s: " % name.name, end="", file=out)
+    if goviaji.syntax_predicate_name:
+        steps, syntax_ok = goviaji.syntax_check(expr)
+        if not syntax_ok:
+            print("syntax check failure \"%s\" %s\n" % (expr.to_str(), goviaji.steps_report(steps)), file=out)
+            print(file=out)
+            return
+        else:
+            print("syntax ok %s." % goviaji.steps_report(steps), end="", file=out)
+
+    current_expr = expr
+
+    if not goviaji.eval_predicate_name:
+        if goviaji.value_predicate_name:
+            steps, is_value = goviaji.value_check(current_expr)
+            if is_value:
+                print(" value %s" % goviaji.steps_report(steps), file=out)
+            else:
+                print(" not value %s" % goviaji.steps_report(steps), file=out)
+        else:
+            print(file=out)
+
+        print(file=out)
+        return
+
+    print(" Evaluating:", file=out)
+
+    if goviaji.evaluator is not None:
+        run_evaluator(goviaji, current_expr, out)
+        return
+
+    for s in range(goviaji.max_eval_steps):
+        print("\t[%d]\t%s: " % (s, goviaji.compiler.rules_db.collapse_definitions(current_expr).to_str()),
+              end="", file=out)
+
+        if goviaji.value_predicate_name:
+            steps, is_value = goviaji.value_check(current_expr)
+            if is_value:
+                print("value %s" % goviaji.steps_report(steps), file=out)
+                break
+
+            print("not value %s, " % goviaji.steps_report(steps), end="", file=out)
 
-def run_file(file_name):
+        steps, current_expr = goviaji.eval_step(current_expr)
+        if current_expr is None:
+            print("eval failure %s. Term is stuck." % goviaji.steps_report(steps), file=out)
+            break
+
+        print("eval ok %s" % goviaji.steps_report(steps), file=out)
+        if s == goviaji.max_eval_steps - 1:
+            print("Calculation stopped after %d steps" % goviaji.max_eval_steps, file=out)
+
+    print(file=out)
+
+
+# the eval loop of run_output with the evaluator of goviaji. Terms with an eval step are not checked for being values
+def run_evaluator(goviaji, expr, out):
+    for s, (steps, current_expr, state) in enumerate(goviaji.evaluator.evaluate(expr)):
+        if state == "stopped":
+            print("Calculation stopped after %d steps" % goviaji.max_eval_steps, file=out)
+            break
+
+        print("\t[%d]\t%s: " % (s, goviaji.compiler.rules_db.collapse_definitions(current_expr).to_str()),
+              end="", file=out)
+        if state == "value":
+            print("value %s" % goviaji.steps_report(steps), file=out)
+        elif state == "stuck":
+            print("eval failure %s. Term is stuck." % goviaji.steps_report(steps), file=out)
+        else:
+            print("eval ok %s" % goviaji.steps_report(steps), file=out)
+
+    print(file=out)
+
+
+# the Goviaji of a worker process of run_file, forked from the process that compiled it
+worker_goviaji = None
+
+
+def init_worker(goviaji):
+    global worker_goviaji
+    worker_goviaji = goviaji
+    if goviaji.prover_cache.store is not None:
+        goviaji.prover_cache.store.reconnect()
+
+
+# returns what run_output printed, and the loop check counters of the evaluation
+def run_output_in_worker(name):
+    goviaji = worker_goviaji
+    goviaji.loop_stats = {"loop_checks": 0, "branches_pruned": 0}
+    name = goviaji.compiler.rules_db.constants[name]
+    out = io.StringIO()
+    run_output(goviaji, name, goviaji.compiler.expressions_to_print[name][0], out)
+    if goviaji.prover_cache.store is not None:
+        goviaji.prover_cache.store.flush()
+
+    return out.getvalue(), goviaji.loop_stats
+
+
+# with jobs > 1 the outputs are evaluated by that many worker processes, each with its own prover cache, and printed
+# in their original order. Profiles and flamegraphs are only collected by a sequential run.
+# or_parallel is the number of processes sharing the branches of each proof (see Goviaji.or_parallel_jobs)
+def run_file(file_name, search_strategy="dfs", loop_check=False, proof_cache_file=None, profile=False,
+             flamegraph_file=None, jobs=1, or_parallel=1, deterministic=False, eval_driver=False,
+             use_module_cache=True):
     print("Running file %s" % file_name)
     try:
-        goviaji = Goviaji(file_name)
+        goviaji = Goviaji(file_name, proof_cache_file, use_module_cache)
     except CompilerError as err:
         print("Compilation error: " + err.args[0], file=stderr)
         exit(1)
@@ -76,6 +357,19 @@ def run_file(file_name):
         print("Rules error: " + err.args[0], file=stderr)
         exit(1)
 
+    goviaji.search_strategy = search_strategy
+    goviaji.loop_check = loop_check
+    goviaji.or_parallel_jobs = or_parallel
+    goviaji.or_parallel_deterministic = deterministic
+    if eval_driver:
+        goviaji.evaluator = Evaluator(goviaji)
+
+    if profile:
+        goviaji.profiler = ProofProfiler()
+
+    if flamegraph_file:
+        goviaji.stack_recorder = StackRecorder(os.path.basename(file_name))
+
     if not goviaji.syntax_predicate_name:
         print("Rules have no predicate \"term\", skipping syntax checks")
 
@@ -85,61 +379,109 @@ def run_file(file_name):
     if not goviaji.eval_predicate_name:
         print("Rules have no predicate \"eval\", skipping evaluation")
 
-    for name, (expr, src) in goviaji.compiler.expressions_to_print.items():
-        print("Output %s: " % name.name, end="")
-        if goviaji.syntax_predicate_name:
-            steps, syntax_ok = goviaji.syntax_check(expr)
-            if not syntax_ok:
-                print("syntax check failure \"%s\" %s\n" % (expr.to_str(), goviaji.steps_report(steps)))
-                print()
-                continue
-            else:
-                print("syntax ok %s." % goviaji.steps_report(steps), end="")
+    outputs = goviaji.compiler.expressions_to_print
+    if jobs > 1 and not profile and not flamegraph_file:
+        with multiprocessing.get_context("fork").Pool(jobs, init_worker, (goviaji,)) as pool:
+            for text, loop_stats in pool.imap(run_output_in_worker, [name.name for name in outputs.keys()]):
+                print(text, end="")
+                for counter, value in loop_stats.items():
+                    goviaji.loop_stats[counter] += value
+    else:
+        for name, (expr, src) in outputs.items():
+            run_output(goviaji, name, expr, sys.stdout)
 
-        current_expr = expr
+    if loop_check:
+        print("Loop check: %d branches cut out of %d checked" %
+              (goviaji.loop_stats["branches_pruned"], goviaji.loop_stats["loop_checks"]))
 
-        if not goviaji.eval_predicate_name:
-            if goviaji.value_predicate_name:
-                steps, is_value = goviaji.value_check(current_expr)
-                if is_value:
-                    print(" value %s" % goviaji.steps_report(steps))
-                else:
-                    print(" not value %s" % goviaji.steps_report(steps))
-            else:
-                print()
+    if profile:
+        print(goviaji.profiler.report())
 
-            print()
-            continue
+    if flamegraph_file:
+        goviaji.stack_recorder.write(flamegraph_file)
+
+    goviaji.close()
+    print()
 
-        print(" Evaluating:")
 
-        for s in range(goviaji.max_eval_steps):
-            print("\t[%d]\t%s: " % (s, goviaji.compiler.rules_db.collapse_definitions(current_expr).to_str()),
-                  end="")
+# runs the outputs of the file like run_file, then again every time one of the files it was compiled from changes,
+# until interrupted. The proof results that the changes cannot affect are kept between the runs
+def watch_file(file_name, search_strategy="dfs", loop_check=False, proof_cache_file=None, eval_driver=False,
+               use_module_cache=True, interval=0.5):
+    print("Watching file %s" % file_name)
+    try:
+        goviaji = Goviaji(file_name, proof_cache_file, use_module_cache)
+    except CompilerError as err:
+        print("Compilation error: " + err.args[0], file=stderr)
+        exit(1)
+    except rules.RulesError as err:
+        print("Rules error: " + err.args[0], file=stderr)
+        exit(1)
 
-            if goviaji.value_predicate_name:
-                steps, is_value = goviaji.value_check(current_expr)
-                if is_value:
-                    print("value %s" % goviaji.steps_report(steps))
-                    break
+    goviaji.search_strategy = search_strategy
+    goviaji.loop_check = loop_check
+    goviaji.prover_cache.goals = {}
+    if eval_driver:
+        goviaji.evaluator = Evaluator(goviaji)
 
-                print("not value %s, " % goviaji.steps_report(steps), end="")
+    while True:
+        start = time.perf_counter()
+        for name, (expr, src) in goviaji.compiler.expressions_to_print.items():
+            run_output(goviaji, name, expr, sys.stdout)
 
-            steps, current_expr = goviaji.eval_step(current_expr)
-            if current_expr is None:
-                print("eval failure %s. Term is stuck." % goviaji.steps_report(steps))
-                break
+        print("Outputs run in %.1f ms, waiting for changes..." % ((time.perf_counter() - start) * 1e3))
+        # a failed reload is tried again at every interval, and its error is only printed when it changes
+        changed_files = []
+        last_error = None
+        while not changed_files:
+            time.sleep(interval)
+            start = time.perf_counter()
+            try:
+                changed_files, change = goviaji.reload()
+            except CompilerError as err:
+                error = "Compilation error: " + err.args[0]
+            except rules.RulesError as err:
+                error = "Rules error: " + err.args[0]
+            else:
+                continue
 
-            print("eval ok %s" % goviaji.steps_report(steps))
-            if s == goviaji.max_eval_steps - 1:
-                print("Calculation stopped after %d steps" % goviaji.max_eval_steps)
+            if error != last_error:
+                print(error, file=stderr)
+                last_error = error
 
+        print("Reloaded %s in %.1f ms: %d rules changed, %d affected, %d proof results kept" %
+              (", ".join(os.path.basename(f) for f in changed_files), (time.perf_counter() - start) * 1e3,
+               len(change.changed), len(change.affected), len(goviaji.prover_cache)))
         print()
 
-    print()
-
 
 if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description="Run a goviaji file")
+    arg_parser.add_argument("file", nargs="?", default="systems/untyped_lambda/lambda_nb_tests.goviaji")
+    arg_parser.add_argument("--strategy", default="dfs",
+                            choices=list(prover.search_strategies.keys()) + ["tabled", "trail"],
+                            help="proof search strategy")
+    arg_parser.add_argument("--loop-check", action="store_true",
+                            help="cut proof branches whose goals are a variant of those of an ancestor")
+    arg_parser.add_argument("--proof-cache", metavar="FILE", help="sqlite file keeping proof results between runs")
+    arg_parser.add_argument("--profile", action="store_true", help="print the work done per rule and predicate")
+    arg_parser.add_argument("--flamegraph", metavar="FILE",
+                            help="write the rule stacks of the proofs in collapsed stack format")
+    arg_parser.add_argument("--jobs", type=int, default=1, help="number of processes evaluating the outputs")
+    arg_parser.add_argument("--or-parallel", type=int, default=1, metavar="JOBS",
+                            help="number of processes sharing the top-level branches of each proof")
+    arg_parser.add_argument("--deterministic", action="store_true",
+                            help="with --or-parallel, give the first answer of the sequential proof")
+    arg_parser.add_argument("--eval-driver", action="store_true",
+                            help="evaluate reusing the work of the previous eval steps")
+    arg_parser.add_argument("--watch", action="store_true",
+                            help="run the outputs again whenever one of the files changes")
+    arg_parser.add_argument("--no-module-cache", action="store_true",
+                            help="compile every file instead of loading the unchanged ones from their cache folder")
+    args = arg_parser.parse_args()
+    if args.strategy == "trail" and (args.loop_check or args.profile or args.flamegraph):
+        arg_parser.error("--strategy trail does not support --loop-check, --profile or --flamegraph")
+
     #run_file("systems/untyped_arithmetic/b.goviaji")
     #run_file("systems/untyped_arithmetic/nb.goviaji")
     #run_file("systems/untyped_arithmetic/nb_branches_first.goviaji")
@@ -147,4 +489,10 @@ if __name__ == '__main__':
     #run_file("systems/untyped_arithmetic/nb_with_wrong.goviaji")
     #run_file("systems/untyped_lambda/lambda_semantics.goviaji")
     #run_file("systems/untyped_lambda/cn_tests.goviaji")
-    run_file("systems/untyped_lambda/lambda_nb_tests.goviaji")
+    if args.watch:
+        watch_file(args.file, args.strategy, args.loop_check, args.proof_cache, args.eval_driver,
+                   not args.no_module_cache)
+    else:
+        run_file(args.file, args.strategy, args.loop_check, args.proof_cache, args.profile, args.flamegraph,
+                 args.jobs, args.or_parallel, args.deterministic, args.eval_driver,
+                 not args.no_module_cache)
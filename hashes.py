@@ -1,11 +1,15 @@
-import random
+import hashlib
 
 hash_mask = 0xffffffffffffffff
 combinator_value = 0xa0cf5a622e18b479
 
+# hashes are the same in every process, so they can be used as keys of caches stored on disk
+hashes_seed = 0x5d0f2c3b8e4a7169
 
-def new_hash():
-    return random.getrandbits(64)
+
+def new_hash(name):
+    return int.from_bytes(hashlib.blake2b(name.encode(), digest_size=8, key=hashes_seed.to_bytes(8, "little"))
+                          .digest(), "little")
 
 
 def combine_hashes(h1, h2):
@@ -20,6 +24,6 @@ def get_hash_for_idx(idx1, idx2):
         hashes_for_idx.append([])
 
     while idx2 >= len(hashes_for_idx[idx1]):
-        hashes_for_idx[idx1].append(new_hash())
+        hashes_for_idx[idx1].append(new_hash("%d.%d" % (idx1, len(hashes_for_idx[idx1]))))
 
     return hashes_for_idx[idx1][idx2]
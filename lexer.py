@@ -161,23 +161,25 @@ class Tokenizer:
         self.cur_row = row
 
 
+# the tokens are read from the list with a cursor, which pop moves forward, so parsing takes linear time
 class Tokens:
     def __init__(self, tokens, lines):
         self.tokens = tokens
+        self.position = 0
         self.lines = lines
         self.next_begin_pos = tokens[0].pos_begin() if len(tokens) > 0 else (0, 0)
         self.last_end_pos = 0, 0
 
     def is_empty(self):
-        return len(self.tokens) == 0
+        return self.position >= len(self.tokens)
 
     def next(self):
-        return self.tokens[0]
+        return self.tokens[self.position]
 
     def pop(self):
-        self.last_end_pos = self.next().pos_end()
-        next_token = self.tokens[0]
-        self.tokens.pop(0)
+        next_token = self.next()
+        self.last_end_pos = next_token.pos_end()
+        self.position += 1
         if not self.is_empty():
             self.next_begin_pos = self.next().pos_begin()
 
@@ -194,7 +196,21 @@ def is_punctuation(s):
     return s.isprintable() and not any(c.isalnum() or c == "_" for c in s) and s != ")" and s != "("
 
 
-def tokenize(text):
+# the second pass of tokenize_by_char: consecutive punctuation characters make up a single constant
+def join_punctuation(tokens):
+    joined_tokens = []
+    for token in tokens:
+        if is_punctuation(token.string) and len(joined_tokens) > 0 and is_punctuation(joined_tokens[-1].string) and \
+                        joined_tokens[-1].loc[1] == token.loc[0]:
+            joined_tokens[-1].string += token.string
+            joined_tokens[-1].loc = joined_tokens[-1].loc[0], token.loc[1]
+        else:
+            joined_tokens.append(token)
+
+    return joined_tokens
+
+
+def tokenize_by_char(text):
     tokenizer = Tokenizer()
     lines = text.split("\n")
 
@@ -203,14 +219,62 @@ def tokenize(text):
             tokenizer.take_char(c, row, col, line)
 
     tokenizer.finish_token()
+    return Tokens(join_punctuation(tokenizer.tokens), lines)
+
+
+# the tokens of Tokenizer for ASCII characters, isspace, isupper, isalnum etc. being those of str. Each match is
+# a token or a comment with the spaces before it, the group of a token being one of the *_group constants
+ascii_punctuation = "".join(c for c in map(chr, range(0x21, 0x7f)) if not c.isalnum() and c not in "_#()")
+ascii_spaces = " \t\r\x0b\x0c\x1c\x1d\x1e\x1f"
+token_re = re.compile(r"[%s]*(?:#.*"
+                      r"|([A-Z][A-Za-z0-9_]*)"
+                      r"|([0-9]+)"
+                      r"|([a-z_][A-Za-z0-9_]*|[%s]+|[()])"
+                      r"|([^%s]))" % (re.escape(ascii_spaces), re.escape(ascii_punctuation), re.escape(ascii_spaces)))
+variable_group = 1
+number_group = 2
+constant_group = 3
+invalid_group = 4
+
+
+# appends the tokens of line to tokens with a single regular expression scan. Lines with other characters than
+# ASCII ones are given to Tokenizer, whose character classes are those of Unicode
+def tokenize_line(line, row, tokens):
+    if not line.isascii():
+        tokenizer = Tokenizer()
+        for col, c in enumerate(line):
+            tokenizer.take_char(c, row, col, line)
 
-    joined_tokens = []
-    for token in tokenizer.tokens:
-        if is_punctuation(token.string) and len(joined_tokens) > 0 and is_punctuation(joined_tokens[-1].string) and \
-                        joined_tokens[-1].loc[1] == token.loc[0]:
-            joined_tokens[-1].string += token.string
-            joined_tokens[-1].loc = joined_tokens[-1].loc[0], token.loc[1]
+        tokenizer.finish_token()
+        tokens.extend(join_punctuation(tokenizer.tokens))
+        return
+
+    variable_type = TokenType.VARIABLE
+    constant_type = TokenType.CONSTANT
+    for match in token_re.finditer(line):
+        group = match.lastindex
+        if group is None:
+            continue
+
+        begin, end = match.span(group)
+        if group == constant_group:
+            tokens.append(Token(constant_type, line[begin:end], ((row, begin), (row, end))))
+        elif group == variable_group:
+            tokens.append(Token(variable_type, line[begin:end], ((row, begin), (row, end))))
+        elif group == number_group:
+            if line[end:end + 1].isalpha():
+                raise RuleParseError("invalid number constant " + at_pos_str(line, row, begin, end + 1))
+
+            tokens.append(Token(constant_type, line[begin:end], ((row, begin), (row, end))))
         else:
-            joined_tokens.append(token)
+            raise RuleParseError("invalid character \"%s\" %s" % (line[begin], at_pos_str(line, row, begin, end)))
+
+
+# gives the same tokens as tokenize_by_char, scanning a line at a time instead of a character at a time
+def tokenize(text):
+    lines = text.split("\n")
+    tokens = []
+    for row, line in enumerate(lines):
+        tokenize_line(line, row, tokens)
 
-    return Tokens(joined_tokens, lines)
+    return Tokens(tokens, lines)
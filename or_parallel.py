@@ -0,0 +1,173 @@
+import functools
+import multiprocessing
+import queue
+import prover
+from prover import FailMark
+from expressions import Application, Variable
+from proof_cache import encode_answer, decode_answer, decode_expression
+from tabling import variant_leaves
+
+
+# the last child of a goal expanded by depth-first search marks the goal as false once all the others have failed,
+# which only holds when they are explored in sequence
+def is_exhaustion_branch(node):
+    answer, prop, ancestors = node
+    return len(prop) == 2 and isinstance(prop[1], FailMark) and prop[1].goal_check_hash is None
+
+
+def proof_branches(nodes):
+    return [node for node in nodes if not is_exhaustion_branch(node)]
+
+
+# the rules, the prover cache entries and the number of the current proof of the OrParallelPool whose workers are
+# forked from this process
+worker_context = None
+
+
+# the proposition as one goal encoded relative to itself, with the kinds of its variable leaves, so that a worker
+# can rebuild a variant of it from its own constants
+def encode_proposition(proposition):
+    goal = functools.reduce(Application, proposition)
+    kinds = "".join("?" if isinstance(leaf, Variable) else "_" for leaf in variant_leaves(goal))
+    return len(proposition), kinds, encode_answer(goal, goal)
+
+
+def decode_proposition(encoded, rules):
+    length, kinds, encoded_goal = encoded
+    for token in encoded_goal.split(" "):
+        if token[0] == "=":
+            rules.add_constant_by_name(token[1:])
+
+    leaves = [rules.introduce_variable() if kind == "?" else rules.introduce_constant() for kind in kinds]
+    goal = decode_expression(leaves, encoded_goal, rules)
+    proposition = []
+    for i in range(length - 1):
+        goal, last = goal.elems
+        proposition.append(last)
+
+    proposition.append(goal)
+    proposition.reverse()
+    return proposition
+
+
+# proves a proposition following only the index-th branch of its start node, with a copy of the prover cache
+# entries of the pool. The proof stops once the pool has moved on to another one. Returns the number of branches
+# of the start node with the result; the answer is encoded relative to the proposition, so that the process that
+# started the proof can rebuild it from its own leaves
+def prove_branch(task):
+    proof_number, encoded_proposition, steps_budget, search_strategy, loop_check, index = task
+    rules, cache_entries, current_proof = worker_context
+    proposition = decode_proposition(encoded_proposition, rules)
+    loop_stats = {"loop_checks": 0, "branches_pruned": 0}
+    branch_counts = []
+
+    def select_branch(nodes):
+        branches = proof_branches(nodes)
+        branch_counts.append(len(branches))
+        return branches[index:index + 1]
+
+    try:
+        steps, subs = next(prover.prove_dfs(rules, proposition, steps_budget, dict(cache_entries),
+                                            search_strategy=search_strategy, loop_check=loop_check,
+                                            loop_stats=loop_stats, root_branches=select_branch,
+                                            cancelled=lambda: current_proof.value != proof_number))
+    except prover.ProofTimeout:
+        return index, 0, 0, None, loop_stats
+
+    branch_count = branch_counts[0] if branch_counts else 0
+    if subs is None:
+        return index, branch_count, steps, None, loop_stats
+
+    goal = functools.reduce(Application, proposition)
+    return index, branch_count, steps, encode_answer(goal, subs.apply(goal)), loop_stats
+
+
+# OR-parallel depth-first proofs: the children of the start node of prove_dfs are shared among a pool of jobs worker
+# processes, each proving the proposition down its own branch with its own copy of the prover cache entries and its
+# own steps budget. The first answer found stops the other workers. With deterministic, an answer is only accepted
+# once all the branches before it have failed, so it is the first answer of the sequential proof (unless one of
+# those branches ran out of steps, which stops the proof).
+# The workers are forked once, with the rules and the entries of the proof_cache.ProofCache tried_goals at the time,
+# so the pool has to be closed and replaced once the rules change. Only the first answer of a proof is given. The
+# pool cannot be started by a worker of another pool, which cannot have children
+class OrParallelPool:
+    def __init__(self, rules, tried_goals, jobs):
+        global worker_context
+
+        self.rules = rules
+        self.jobs = jobs
+        context = multiprocessing.get_context("fork")
+        self.current_proof = context.Value("q", 0, lock=False)
+        worker_context = rules, dict(tried_goals.entries), self.current_proof
+        self.pool = context.Pool(jobs)
+        worker_context = None
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+    def prove(self, proposition, steps_budget=None, search_strategy="dfs", loop_check=False, loop_stats=None,
+              deterministic=False):
+        if loop_stats is None:
+            loop_stats = {"loop_checks": 0, "branches_pruned": 0}
+
+        def out_of_steps(steps):
+            return steps_budget is not None and steps >= steps_budget
+
+        # branches are submitted while jobs are free, the first result telling how many branches there are
+        self.current_proof.value += 1
+        task = self.current_proof.value, encode_proposition(proposition), steps_budget, search_strategy, loop_check
+        results_queue = queue.SimpleQueue()
+        branch_count = self.jobs
+        submitted = 0
+        results = {}
+        next_index = 0
+        max_steps = 0
+        found = None
+        try:
+            while True:
+                while submitted < branch_count and submitted - len(results) < self.jobs:
+                    self.pool.apply_async(prove_branch, (task + (submitted,),), callback=results_queue.put,
+                                          error_callback=results_queue.put)
+                    submitted += 1
+
+                if len(results) == submitted:
+                    break
+
+                result = results_queue.get()
+                if isinstance(result, BaseException):
+                    raise result
+
+                index, count, steps, answer, branch_loop_stats = result
+                for counter, value in branch_loop_stats.items():
+                    loop_stats[counter] += value
+
+                branch_count = count
+                max_steps = max(max_steps, steps)
+                results[index] = steps, answer
+                if not deterministic:
+                    if answer is not None:
+                        found = steps, answer
+                        break
+
+                    continue
+
+                while next_index in results and results[next_index][1] is None and \
+                        not out_of_steps(results[next_index][0]):
+                    next_index += 1
+
+                if next_index in results:
+                    found = results[next_index]
+                    break
+        finally:
+            # stops the workers still proving branches of this proposition
+            self.current_proof.value += 1
+
+        if found is None or found[1] is None:
+            yield max_steps if found is None else found[0], None
+            return
+
+        steps, answer = found
+        goal = functools.reduce(Application, proposition)
+        yield steps, goal.unify(decode_answer(goal, answer, self.rules))
+        yield steps, None
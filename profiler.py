@@ -0,0 +1,69 @@
+rule_counters = ["unify_attempts", "unify_successes", "branches", "time"]
+predicate_counters = ["goals", "cache_hits", "cache_misses", "unify_attempts", "unify_successes", "branches", "time"]
+
+
+# Counters of the work done by prove_dfs and Rules.get_applicable_rules, per rule name and per goal predicate
+# (see Rules.get_predicate). Times are cumulative wall times in seconds: the time of a rule is spent unifying goals
+# with its conclusion and instantiating its premises, the time of a predicate is spent expanding goals of it
+class ProofProfiler:
+    def __init__(self):
+        self.by_rule = {}
+        self.by_predicate = {}
+
+    def rule_stats(self, rule):
+        name = rule.name.name
+        if name not in self.by_rule:
+            self.by_rule[name] = dict.fromkeys(rule_counters, 0)
+
+        return self.by_rule[name]
+
+    def predicate_stats(self, predicate):
+        if predicate not in self.by_predicate:
+            self.by_predicate[predicate] = dict.fromkeys(predicate_counters, 0)
+
+        return self.by_predicate[predicate]
+
+    def record_unify(self, rule, predicate, success, elapsed):
+        rule_stats = self.rule_stats(rule)
+        predicate_stats = self.predicate_stats(predicate)
+        rule_stats["unify_attempts"] += 1
+        predicate_stats["unify_attempts"] += 1
+        if success:
+            rule_stats["unify_successes"] += 1
+            predicate_stats["unify_successes"] += 1
+
+        rule_stats["time"] += elapsed
+
+    def record_cache_lookup(self, predicate, hit):
+        self.predicate_stats(predicate)["cache_hits" if hit else "cache_misses"] += 1
+
+    def record_rule(self, rule, elapsed):
+        self.rule_stats(rule)["time"] += elapsed
+
+    def record_branch(self, rule, predicate):
+        self.rule_stats(rule)["branches"] += 1
+        self.predicate_stats(predicate)["branches"] += 1
+
+    def record_goal(self, predicate, elapsed):
+        predicate_stats = self.predicate_stats(predicate)
+        predicate_stats["goals"] += 1
+        predicate_stats["time"] += elapsed
+
+    def to_dict(self):
+        return {"rules": {name: dict(stats) for name, stats in self.by_rule.items()},
+                "predicates": {predicate: dict(stats) for predicate, stats in self.by_predicate.items()}}
+
+    def report(self, sort_by="time", limit=20):
+        lines = []
+        for title, table, counters in [("rule", self.by_rule, rule_counters),
+                                       ("predicate", self.by_predicate, predicate_counters)]:
+            rows = sorted(table.items(), key=lambda item: item[1][sort_by], reverse=True)[:limit]
+            width = max([len(title)] + [len(name) for name, stats in rows])
+            lines.append(title.ljust(width) + "".join("%16s" % c for c in counters))
+            for name, stats in rows:
+                lines.append(name.ljust(width) + "".join("%16.3f" % stats[c] if c == "time" else "%16d" % stats[c]
+                                                         for c in counters))
+
+            lines.append("")
+
+        return "\n".join(lines)
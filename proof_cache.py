@@ -0,0 +1,228 @@
+import atexit
+import collections
+import sqlite3
+from expressions import Application, Variable
+from tabling import variant_leaves
+
+
+# sqlite integers are signed
+def to_signed_64(h):
+    return h - (1 << 64) if h >= 1 << 63 else h
+
+
+# Results of goals stored in an sqlite file, keyed by the fingerprint of the rules and the goal hash, so they can be
+# shared between runs and processes. Results are written in batches, and the last batch when the process exits.
+# The store also keeps the first answer found for a goal by each search strategy, with and without loop checks
+# (which can cut the branch of the first answer), written relative to the leaves of the goal so that it can be given
+# to any variant of it
+class ProofStore:
+    def __init__(self, file_name, rules_db, batch_size=1000):
+        self.rules_db = rules_db
+        self.file_name = file_name
+        self.connection = sqlite3.connect(file_name, timeout=60)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS proofs (fingerprint INTEGER, goal_hash INTEGER, "
+                                "result INTEGER, PRIMARY KEY (fingerprint, goal_hash)) WITHOUT ROWID")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS answers (fingerprint INTEGER, goal_hash INTEGER, "
+                                "strategy TEXT, loop_check INTEGER, answer TEXT, "
+                                "PRIMARY KEY (fingerprint, goal_hash, strategy, loop_check)) WITHOUT ROWID")
+        self.connection.commit()
+        self.fingerprint = to_signed_64(rules_db.fingerprint())
+        self.batch_size = batch_size
+        self.unsaved = {}
+        self.unsaved_answers = {}
+        atexit.register(self.flush)
+
+    # results are stored for the rules as they are now
+    def update_fingerprint(self):
+        self.flush()
+        self.fingerprint = to_signed_64(self.rules_db.fingerprint())
+
+    # a forked process cannot use the connection of its parent
+    def reconnect(self):
+        self.connection = sqlite3.connect(self.file_name, timeout=60)
+        self.unsaved = {}
+        self.unsaved_answers = {}
+
+    def get(self, goal_hash):
+        if goal_hash in self.unsaved:
+            return self.unsaved[goal_hash]
+
+        row = self.connection.execute("SELECT result FROM proofs WHERE fingerprint = ? AND goal_hash = ?",
+                                      (self.fingerprint, to_signed_64(goal_hash))).fetchone()
+        return None if row is None else bool(row[0])
+
+    def put(self, goal_hash, result):
+        self.unsaved[goal_hash] = result
+        if len(self.unsaved) >= self.batch_size:
+            self.flush()
+
+    # answer is an instance of an expression in the goal, e.g. the value of its variable
+    def put_answer(self, goal, strategy, loop_check, answer):
+        self.unsaved_answers[(goal.get_hash(), strategy, loop_check)] = encode_answer(goal, answer)
+        if len(self.unsaved_answers) >= self.batch_size:
+            self.flush()
+
+    def get_answer(self, goal, strategy, loop_check):
+        key = goal.get_hash(), strategy, loop_check
+        if key in self.unsaved_answers:
+            return decode_answer(goal, self.unsaved_answers[key], self.rules_db)
+
+        row = self.connection.execute("SELECT answer FROM answers WHERE fingerprint = ? AND goal_hash = ? AND "
+                                      "strategy = ? AND loop_check = ?",
+                                      (self.fingerprint, to_signed_64(key[0]), strategy, int(loop_check))).fetchone()
+        return None if row is None else decode_answer(goal, row[0], self.rules_db)
+
+    def flush(self):
+        if not self.unsaved and not self.unsaved_answers:
+            return
+
+        self.connection.executemany("INSERT OR REPLACE INTO proofs VALUES (?, ?, ?)",
+                                    [(self.fingerprint, to_signed_64(h), int(result))
+                                     for h, result in self.unsaved.items()])
+        self.connection.executemany("INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?)",
+                                    [(self.fingerprint, to_signed_64(h), strategy, int(loop_check), answer)
+                                     for (h, strategy, loop_check), answer in self.unsaved_answers.items()])
+        self.connection.commit()
+        self.unsaved = {}
+        self.unsaved_answers = {}
+
+
+# preorder list of the nodes of answer: "@" for an application, "#i" for the i-th leaf of the goal, "=name" for a
+# constant, "?name" for a variable and "_name" for a generated constant not found in the goal
+def encode_answer(goal, answer):
+    leaves_idx = {leaf: i for i, leaf in enumerate(variant_leaves(goal))}
+    tokens = []
+    to_visit = [answer]
+    while to_visit:
+        e = to_visit.pop()
+        if isinstance(e, Application):
+            tokens.append("@")
+            to_visit.append(e.elems[1])
+            to_visit.append(e.elems[0])
+        elif e in leaves_idx:
+            tokens.append("#%d" % leaves_idx[e])
+        elif isinstance(e, Variable):
+            tokens.append("?" + e.name)
+        elif e.generated:
+            tokens.append("_" + e.name)
+        else:
+            tokens.append("=" + e.name)
+
+    return " ".join(tokens)
+
+
+# variables and generated constants that are not in the goal are replaced with new ones
+def decode_answer(goal, encoded, rules_db):
+    return decode_expression(variant_leaves(goal), encoded, rules_db)
+
+
+# decodes an expression encoded by encode_answer relative to a goal whose variant leaves are leaves
+def decode_expression(leaves, encoded, rules_db):
+    new_leaves = {}
+    stack = []
+    for token in reversed(encoded.split(" ")):
+        if token == "@":
+            left = stack.pop()
+            stack.append(Application(left, stack.pop()))
+        elif token[0] == "#":
+            stack.append(leaves[int(token[1:])])
+        elif token[0] == "=":
+            stack.append(rules_db.constants[token[1:]])
+        else:
+            if token not in new_leaves:
+                new_leaves[token] = rules_db.introduce_variable() if token[0] == "?" else rules_db.introduce_constant()
+
+            stack.append(new_leaves[token])
+
+    return stack[0]
+
+
+# Results of goals tried by the prover, keyed by goal hash, with at most max_entries entries kept between proofs.
+# Entries are evicted least recently used first, but only once the proof that read or wrote them is over: the
+# marks of a proof in progress rely on the results it has seen staying in the cache (e.g. a goal proven by one
+# alternative must not be recorded as false once the other alternatives fail). Proofs sharing a cache are run one
+# after the other, and start_proof has to be called before each of them.
+# With a store, results missing from memory are looked up in it and every new result is saved to it
+class ProofCache:
+    def __init__(self, max_entries=100000, store=None):
+        self.max_entries = max_entries
+        self.store = store
+        self.entries = collections.OrderedDict()
+        # entries read or written by the current proof, which cannot be evicted until it is over
+        self.pinned = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.store_hits = 0
+        # the goals of the entries by hash, filled by the provers if not None and emptied with the entries (see
+        # Goviaji.reload)
+        self.goals = None
+
+    def start_proof(self):
+        for h, result in self.pinned.items():
+            self.entries[h] = result
+
+        self.pinned = {}
+        while len(self.entries) > self.max_entries:
+            h, result = self.entries.popitem(last=False)
+            if self.goals is not None:
+                self.goals.pop(h, None)
+
+            self.evictions += 1
+
+    def __contains__(self, goal_hash):
+        if goal_hash in self.pinned:
+            self.hits += 1
+            return True
+
+        if goal_hash in self.entries:
+            self.hits += 1
+            self.pinned[goal_hash] = self.entries.pop(goal_hash)
+            return True
+
+        if self.store is not None:
+            result = self.store.get(goal_hash)
+            if result is not None:
+                self.store_hits += 1
+                self.pinned[goal_hash] = result
+                return True
+
+        self.misses += 1
+        return False
+
+    def __getitem__(self, goal_hash):
+        if goal_hash not in self.pinned:
+            self.pinned[goal_hash] = self.entries.pop(goal_hash)
+
+        return self.pinned[goal_hash]
+
+    def __setitem__(self, goal_hash, result):
+        self.entries.pop(goal_hash, None)
+        self.pinned[goal_hash] = result
+        if self.store is not None:
+            self.store.put(goal_hash, result)
+
+    def __len__(self):
+        return len(self.entries) + len(self.pinned)
+
+    # the store is kept
+    def clear(self):
+        self.entries.clear()
+        self.pinned.clear()
+        if self.goals is not None:
+            self.goals.clear()
+
+    # removes the entries for which keep returns False, keep being given the goal of the entry, or None if its goal
+    # was not recorded in goals. The store is kept
+    def invalidate(self, keep):
+        self.start_proof()
+        goals = {} if self.goals is None else self.goals
+        for h in [h for h in self.entries if not keep(goals.get(h))]:
+            del self.entries[h]
+
+        if self.goals is not None:
+            self.goals = {h: goals[h] for h in self.entries if h in goals}
+
+    def stats(self):
+        return {"entries": len(self), "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "store_hits": self.store_hits}
@@ -1,13 +1,18 @@
 import search
+import functools
+import time
 from substitution import Substitution
-from expressions import Expression
+from expressions import Expression, get_list_hash
 from enum import Enum
 
 
+# pruned_before is the count of branches cut by the loop check when the alternatives of the goal were generated.
+# A cut below the goal may have removed its only proof, so the mark is not applied if branches were cut since
 class GoalProvedMark:
-    def __init__(self, goal_hash, result):
+    def __init__(self, goal_hash, result, pruned_before=None):
         self.hash = goal_hash
         self.result = result
+        self.pruned_before = pruned_before
 
     def to_str(self):
         return "<mark hash %d as %s>" % (self.hash, self.result)
@@ -21,165 +26,354 @@ class FailMark:
         return "<fail>" if self.goal_check_hash is None else "<fail if hash %d is proven>" % self.goal_check_hash
 
 
-def prove_dfs(rules, proposition, steps_budget=None, tried_goals=None, verbose=False):
+# follows the premises of a rule when proof stacks are recorded: the rules of the frame marks in a proposition are
+# the rules whose premises are being proven, innermost first
+class RuleFrameMark:
+    def __init__(self, rule_name):
+        self.rule_name = rule_name
+
+    def to_str(self):
+        return "<end of %s>" % self.rule_name
+
+
+class ProofTimeout(Exception):
+    pass
+
+
+# number of leaves in the goals left to prove, used as the cost estimate of best-first search
+def remaining_goals_size(node):
+    answer, prop, ancestors = node
+    return sum(g.size for g in prop if isinstance(g, Expression))
+
+
+# the variant hash of the answer of a search node, by which iterative deepening tells the answers found by its
+# earlier iterations
+def answer_hash(node):
+    answer, prop, ancestors = node
+    return get_list_hash([expr for var, expr in answer.items()])
+
+
+search_strategies = {
+    "dfs": search.depth_first_search,
+    "iddfs": functools.partial(search.iterative_deepening_search, key=answer_hash),
+    "bfs": search.breadth_first_search,
+    "best_first": functools.partial(search.best_first_search, cost=remaining_goals_size),
+}
+
+
+# with loop_check, a branch is cut when its goals together with the answer built so far are a variant of those of
+# one of its ancestors: any proof of the descendant can be replayed from the ancestor in fewer steps.
+# loop_stats counts the checks done and the branches cut, each of which saves at least one expansion.
+# profiler is a profiler.ProofProfiler collecting counters per rule and per predicate, stack_recorder a
+# flamegraph.StackRecorder sampling the stack of rules applied above the goals expanded.
+# root_branches, if given, is called with the list of the search nodes that are the children of the start node and
+# returns those to explore (see or_parallel).
+# ProofTimeout is raised when a node is expanded after deadline, a time.perf_counter() value, or once cancelled, a
+# function without arguments, returns True.
+# goals_by_hash, if given, is filled with the goals whose results are stored in tried_goals, by hash (see
+# Goviaji.reload)
+def prove_dfs(rules, proposition, steps_budget=None, tried_goals=None, verbose=False, search_strategy="dfs",
+              loop_check=False, loop_stats=None, profiler=None, stack_recorder=None, root_branches=None,
+              deadline=None, goals_by_hash=None, cancelled=None):
     if verbose:
         print("Starting proof of \"%s\"" % ", ".join(p.to_str() for p in proposition))
 
-    start = Substitution(), proposition
-
     if tried_goals is None:
         tried_goals = {}
 
-    def accept_proof_marks(goals):
-        while goals:
-            if isinstance(goals[0], GoalProvedMark):
-                if goals[0].hash not in tried_goals:
-                    if verbose:
-                        print("*** hash=%d marked as %s" % (goals[0].hash, goals[0].result))
+    if loop_stats is None:
+        loop_stats = {"loop_checks": 0, "branches_pruned": 0}
 
-                    tried_goals[goals[0].hash] = goals[0].result
+    # the goals missing from tried_goals, by hash, recorded in goals_by_hash once they are given a result
+    looked_up = {}
 
-                goals.pop(0)
-            elif isinstance(goals[0], FailMark) and goals[0].goal_check_hash and \
-                    (goals[0].goal_check_hash not in tried_goals or
-                         not tried_goals[goals[0].goal_check_hash]):
-                goals.pop(0)
+    def record_goal(h, goal, in_cache):
+        if goals_by_hash is not None:
+            if in_cache:
+                goals_by_hash[h] = goal
             else:
+                looked_up[h] = goal
+
+    def store_result(h, result):
+        tried_goals[h] = result
+        if goals_by_hash is not None and h in looked_up:
+            goals_by_hash[h] = looked_up[h]
+
+    # the fail marks prune the remaining alternatives of a ground goal once one of them has proven it. This relies on
+    # the alternatives being explored one after another, with nothing else interleaved
+    depth_first = search_strategy == "dfs"
+
+    # applies the marks at the front of goals[start:] and returns the index of the first goal left
+    def accept_proof_marks(goals, start):
+        i = start
+        while i < len(goals):
+            goal = goals[i]
+            if isinstance(goal, GoalProvedMark):
+                if goal.pruned_before is not None and goal.pruned_before != loop_stats["branches_pruned"]:
+                    if verbose:
+                        print("*** hash=%d not marked, the loop check cut a branch below it" % goal.hash)
+                elif goal.hash not in tried_goals:
+                    if verbose:
+                        print("*** hash=%d marked as %s" % (goal.hash, goal.result))
+
+                    store_result(goal.hash, goal.result)
+            elif isinstance(goal, FailMark):
+                if not goal.goal_check_hash or \
+                        (goal.goal_check_hash in tried_goals and tried_goals[goal.goal_check_hash]):
+                    break
+            elif not isinstance(goal, RuleFrameMark):
                 break
 
-    def gen_alternative_steps(node):
-        _, prop = node
-        if verbose:
-            print("Trying proposition %s" % ", ".join(g.to_str() for g in prop))
-
-        accept_proof_marks(prop)
+            i += 1
 
-        if not prop:
-            yield Substitution(), []
-            return
+        return i
 
-        first_goal = prop[0]
-        rest_goals = prop[1:]
+    def gen_alternative_steps(prop):
+        # goals proven without branching are consumed in this loop, which moves on to the rest of the proposition.
+        # prop itself is not changed: first is the index of the goal to prove
+        first = 0
+        while True:
+            if verbose:
+                print("Trying proposition %s" % ", ".join(g.to_str() for g in prop[first:]))
 
-        if isinstance(first_goal, FailMark):
-            return
+            first = accept_proof_marks(prop, first)
 
-        h = first_goal.get_hash()
-        is_ground = first_goal.is_ground()
+            if first == len(prop):
+                yield Substitution(), []
+                return
 
-        if verbose:
-            print("Current goal is \"%s\", hash=%d, %s" %
-                  (first_goal.to_str(), h, "ground" if is_ground else "not ground"))
+            first_goal = prop[first]
+            rest_start = first + 1
 
-        if h in tried_goals:
-            proven = tried_goals[h]
-            if proven:
-                if is_ground:
-                    yield from gen_alternative_steps((Substitution(), rest_goals))
-                    return
-            else:
+            if isinstance(first_goal, FailMark):
                 return
 
-        continuations = []
-        #print("Goal: %s" % first_goal.to_str())
-        for new_subs, rule in rules.get_applicable_rules(first_goal):
+            if stack_recorder is not None:
+                stack_recorder.record([g.rule_name for g in reversed(prop[rest_start:])
+                                       if isinstance(g, RuleFrameMark)])
+
+            h = first_goal.get_hash()
+            is_ground = first_goal.is_ground()
+
             if verbose:
-                print("\tRule %s is applicable with substitution [%s]" % (rule.name, new_subs))
+                print("Current goal is \"%s\", hash=%d, %s" %
+                      (first_goal.to_str(), h, "ground" if is_ground else "not ground"))
+
+            in_cache = h in tried_goals
+            record_goal(h, first_goal, in_cache)
+
+            if profiler is not None:
+                predicate = rules.get_predicate(first_goal)
+                profiler.record_cache_lookup(predicate, in_cache)
+                expansion_start = time.perf_counter()
+
+            if in_cache:
+                proven = tried_goals[h]
+                if proven:
+                    if is_ground:
+                        first = rest_start
+                        continue
+                else:
+                    return
 
-            if not rule.premises:
+            continuations = []
+            proven_without_branching = False
+            #print("Goal: %s" % first_goal.to_str())
+            for new_subs, rule in rules.get_applicable_rules(first_goal, profiler):
                 if verbose:
-                    print("\t\t...no premises, goal proven")
+                    print("\tRule %s is applicable with substitution [%s]" % (rule.name, new_subs))
 
-                accept_proof_marks(rest_goals)
-                if is_ground:
+                if profiler is not None:
+                    rule_start = time.perf_counter()
+                    branches_before = len(continuations)
+
+                if not rule.premises:
                     if verbose:
-                        print("\t\t-> no branching, transferring directly to next subgoal")
+                        print("\t\t...no premises, goal proven")
+
+                    rest_start = accept_proof_marks(prop, rest_start)
+                    if is_ground:
+                        if verbose:
+                            print("\t\t-> no branching, transferring directly to next subgoal")
+
+                        if profiler is not None:
+                            profiler.record_goal(predicate, time.perf_counter() - expansion_start)
+
+                        proven_without_branching = True
+                        break
+
+                    unused_subs = new_subs.replacements.keys() & rule.variables
+                    for v in unused_subs:
+                        del new_subs.replacements[v]
+
+                    continuations.append((new_subs,
+                                          [new_subs.apply(g) if isinstance(g, Expression) else g
+                                           for g in prop[rest_start:]]))
+                else:
+                    new_goals = list(map(new_subs.apply, rule.premises))
+                    new_goals_vars = set()
+                    for e in new_goals:
+                       e.collect_variables(new_goals_vars)
+
+                    refresh_subs = rules.refreshing_substitution(new_goals_vars & rule.variables)
+                    new_goals = list(map(refresh_subs.apply, new_goals))
+                    new_subs.compose(refresh_subs, add=False)
+
+                    new_goals_with_marks = []
+                    if is_ground and depth_first:
+                        new_goals_with_marks.append(FailMark(h))
+
+                    rule_failed = False
+                    for g in new_goals:
+                        sub_hash = g.get_hash()
+                        if verbose:
+                            print("\t\tpremise \"%s\", hash=%d" % (g.to_str(), sub_hash))
+
+                        in_cache = sub_hash in tried_goals
+                        record_goal(sub_hash, g, in_cache)
+
+                        if profiler is not None:
+                            profiler.record_cache_lookup(rules.get_predicate(g), in_cache)
+
+                        if in_cache:
+                            proven = tried_goals[sub_hash]
+                            if proven:
+                                if g.is_ground():
+                                    if verbose:
+                                        print("\t\t\talready proven; skipping premise")
+
+                                    continue
+                            else:
+                                if verbose:
+                                    print("\t\t\talready proven to be false; rule failed")
 
-                    yield from gen_alternative_steps((Substitution(), rest_goals))
-                    return
+                                rule_failed = True
+                                break
 
-                unused_subs = new_subs.replacements.keys() & rule.variables
-                for v in unused_subs:
-                    del new_subs.replacements[v]
+                        new_goals_with_marks.append(g)
+                        new_goals_with_marks.append(GoalProvedMark(sub_hash, True))
 
-                continuations.append((new_subs,
-                                      [new_subs.apply(g) if isinstance(g, Expression) else g for g in rest_goals]))
-            else:
-                new_goals = list(map(new_subs.apply, rule.premises))
-                new_goals_vars = set()
-                for e in new_goals:
-                   e.collect_variables(new_goals_vars)
-
-                refresh_subs = rules.refreshing_substitution(new_goals_vars & rule.variables)
-                new_goals = list(map(refresh_subs.apply, new_goals))
-                new_subs.compose(refresh_subs, add=False)
-
-                new_goals_with_marks = []
-                if is_ground:
-                    new_goals_with_marks.append(FailMark(h))
-
-                rule_failed = False
-                for g in new_goals:
-                    sub_hash = g.get_hash()
-                    if verbose:
-                        print("\t\tpremise \"%s\", hash=%d" % (g.to_str(), sub_hash))
+                    if not rule_failed:
+                        if not new_goals_with_marks:
+                            rest_start = accept_proof_marks(prop, rest_start)
+                            if is_ground:
+                                if profiler is not None:
+                                    profiler.record_goal(predicate, time.perf_counter() - expansion_start)
 
-                    if sub_hash in tried_goals:
-                        proven = tried_goals[sub_hash]
-                        if proven:
-                            if g.is_ground():
-                                if verbose:
-                                    print("\t\t\talready proven; skipping premise")
+                                proven_without_branching = True
+                                break
 
-                                continue
-                        else:
-                            if verbose:
-                                print("\t\t\talready proven to be false; rule failed")
+                        if stack_recorder is not None:
+                            new_goals_with_marks.append(RuleFrameMark(rule.name.name))
 
-                            rule_failed = True
-                            break
+                        continuations.append((new_subs, new_goals_with_marks +
+                              [new_subs.apply(g) if isinstance(g, Expression) else g for g in prop[rest_start:]]))
 
-                    new_goals_with_marks.append(g)
-                    new_goals_with_marks.append(GoalProvedMark(sub_hash, True))
+                if profiler is not None:
+                    profiler.record_rule(rule, time.perf_counter() - rule_start)
+                    if len(continuations) > branches_before:
+                        profiler.record_branch(rule, predicate)
 
-                if not rule_failed:
-                    if not new_goals_with_marks:
-                        accept_proof_marks(rest_goals)
-                        if is_ground:
-                            yield from gen_alternative_steps((Substitution(), rest_goals))
-                            return
+            if proven_without_branching:
+                first = rest_start
+                continue
+
+            if verbose:
+                if not continuations:
+                    print("No applicable rules, goal failed")
+                else:
+                    print("%d branches generated" % len(continuations))
 
-                    continuations.append((new_subs, new_goals_with_marks +
-                          [new_subs.apply(g) if isinstance(g, Expression) else g for g in rest_goals]))
+            if profiler is not None:
+                profiler.record_goal(predicate, time.perf_counter() - expansion_start)
 
-        if verbose:
             if not continuations:
-                print("No applicable rules, goal failed")
+                store_result(h, False)
             else:
-                print("%d branches generated" % len(continuations))
+                pruned_before = loop_stats["branches_pruned"] if loop_check else None
+                yield from continuations
+                if depth_first:
+                    yield Substitution(), [GoalProvedMark(h, False, pruned_before), FailMark()]
 
-        if not continuations:
-            tried_goals[h] = False
-        else:
-            yield from continuations
-            yield Substitution(), [GoalProvedMark(h, False), FailMark()]
+            return
+
+    def resultant_hash(answer, prop):
+        return get_list_hash([expr for var, expr in answer.items()] + [g for g in prop if isinstance(g, Expression)])
+
+    # ancestors is the linked list of (hash, rest) pairs of the resultants on the branch, or None without loop_check
+    def is_variant_of_ancestor(h, ancestors):
+        while ancestors is not None:
+            ancestor_hash, ancestors = ancestors
+            if ancestor_hash == h:
+                return True
+
+        return False
+
+    # search nodes carry the answer substitution for the variables of the proposition, composed with the
+    # substitution of every step on the way down
+    def gen_children(node):
+        answer, prop, ancestors = node
+        for subs, new_prop in gen_alternative_steps(prop):
+            new_answer = answer
+            if subs:
+                new_answer = Substitution()
+                for var, expr in answer.items():
+                    new_answer.replace(var, subs.apply(expr) if any(v in subs for v in expr.variables) else expr)
+
+            if loop_check and not is_goal((new_answer, new_prop, None)):
+                loop_stats["loop_checks"] += 1
+                h = resultant_hash(new_answer, new_prop)
+                if is_variant_of_ancestor(h, ancestors):
+                    loop_stats["branches_pruned"] += 1
+                    if verbose:
+                        print("Proposition %s is a variant of an ancestor, branch cut" %
+                              ", ".join(g.to_str() for g in new_prop))
+
+                    continue
+
+                yield new_answer, new_prop, (h, ancestors)
+            else:
+                yield new_answer, new_prop, ancestors
+
+    def gen_neighbors(node):
+        if deadline is not None and time.perf_counter() > deadline:
+            raise ProofTimeout()
+
+        if cancelled is not None and cancelled():
+            raise ProofTimeout()
+
+        if root_branches is not None and node is start_node:
+            return root_branches(list(gen_children(node)))
+
+        return gen_children(node)
 
     def is_goal(node):
-        subs, prop = node
-        return all(isinstance(g, GoalProvedMark) for g in prop)
+        subs, prop, ancestors = node
+        return all(isinstance(g, (GoalProvedMark, RuleFrameMark)) for g in prop)
 
-    vars_in_proposition = set()
+    start_answer = Substitution()
     for e in proposition:
-        e.collect_variables(vars_in_proposition)
-
-    for steps_taken, path in search.depth_first_search(start, gen_alternative_steps, is_goal, steps_budget):
+        for v in e.variables:
+            start_answer.replace(v, v)
+
+    # the goals of the proposition are marked as proven like the premises of a rule, so that exhausting the
+    # alternatives of a goal that has answers does not mark it as false
+    start_prop = []
+    for g in proposition:
+        start_prop.append(g)
+        start_prop.append(GoalProvedMark(g.get_hash(), True))
+
+    start_ancestors = (resultant_hash(start_answer, proposition), None) if loop_check else None
+    start_node = start_answer, start_prop, start_ancestors
+    search_function = search_strategies[search_strategy]
+    for steps_taken, path in search_function(start_node, gen_neighbors, is_goal, steps_budget=steps_budget):
         if path is None:
             yield steps_taken, None
             return
 
-        full_subs = path[0][0]
-        for subs, prop in path[1:]:
-            full_subs.compose(subs)
+        full_subs = Substitution()
+        for var, expr in path[-1][0].items():
+            if expr is not var:
+                full_subs.replace(var, expr)
 
-        full_subs.filter_variables(vars_in_proposition)
         yield steps_taken, full_subs
@@ -1,36 +1,14 @@
-from expressions import Constant, Variable, Application
+import time
+from expressions import Constant, Variable, Application, get_list_hash
+import hashes
 from substitution import Substitution
+from discrimination_tree import DiscriminationTree
 
 
 class RulesError(Exception):
     pass
 
 
-def get_constant_in_front(expr):
-    front = expr
-    while isinstance(front, Application):
-        front = front.elems[0]
-
-    if isinstance(front, Constant):
-        return front
-
-    return None
-
-
-def get_constant_in_second_place(expr):
-    if not isinstance(expr, Application):
-        return None
-
-    front = expr
-    while isinstance(front.elems[0], Application):
-        front = front.elems[0]
-
-    if isinstance(front.elems[1], Constant):
-        return front.elems[1]
-
-    return None
-
-
 class Rules:
     def __init__(self):
         self.constants = {}
@@ -39,8 +17,28 @@ class Rules:
         self.rules_by_name = {}
         self.rules_in_order = []
         self.definitions = {}
-        self.rules_by_constant_in_front = {}
-        self.rules_by_constant_in_second_place = {}
+        self.rules_by_conclusion = DiscriminationTree()
+        self.lookup_stats = {"lookups": 0, "candidates_pruned": 0, "candidates_unified": 0, "unify_successes": 0}
+        self.predicate_constants = set()
+        self.predicates = set()
+
+    # removes the rules and the definitions, keeping the constants
+    def clear(self):
+        self.rules_by_name = {}
+        self.rules_in_order = []
+        self.definitions = {}
+        self.rules_by_conclusion = DiscriminationTree()
+        self.predicate_constants = set()
+        self.predicates = set()
+
+    # the rules and the definitions, which clear replaces without changing them, so that restore can bring them back
+    def rules_state(self):
+        return (self.rules_by_name, self.rules_in_order, self.definitions, self.rules_by_conclusion,
+                self.predicate_constants, self.predicates)
+
+    def restore(self, state):
+        (self.rules_by_name, self.rules_in_order, self.definitions, self.rules_by_conclusion,
+         self.predicate_constants, self.predicates) = state
 
     def introduce_constant(self):
         while True:
@@ -87,40 +85,113 @@ class Rules:
             raise RulesError("duplicate rule %s. Previous definition:\n%s\nDuplicate definition:\n%s" %
                              (rule.name.name, self.rules_by_name[rule.name].definition_src, rule.definition_src))
 
-        constant_in_front = get_constant_in_front(rule.conclusion)
-        if constant_in_front:
-            if constant_in_front not in self.rules_by_constant_in_front:
-                self.rules_by_constant_in_front[constant_in_front] = []
+        self.rules_by_name[rule.name] = rule
+        self.rules_in_order.append(rule)
+        self.rules_by_conclusion.add(rule.conclusion, rule)
+        return rule
+
+    def rebuild_index(self):
+        self.rules_by_conclusion = DiscriminationTree()
+        for rule in self.rules_in_order:
+            self.rules_by_conclusion.add(rule.conclusion, rule)
+
+        self.find_predicate_constants()
+
+    # constants that appear on the top level of rule conclusions and premises but never inside their arguments, e.g.
+    # "eval" or "-->". They tell the predicates of goals apart
+    def find_predicate_constants(self):
+        top_level_constants = set()
+        argument_constants = set()
+        for rule in self.rules_in_order:
+            for e in [rule.conclusion] + rule.premises:
+                for elem in e.collect_level():
+                    if isinstance(elem, Application):
+                        elem.collect_constants(argument_constants)
+                    elif isinstance(elem, Constant):
+                        top_level_constants.add(elem)
+
+        self.predicate_constants = top_level_constants - argument_constants
+        self.predicates = set(self.get_top_level_names(rule.conclusion) for rule in self.rules_in_order)
+
+    def get_top_level_names(self, expr):
+        return tuple(e.name if e in self.predicate_constants else "_" for e in expr.collect_level())
+
+    # e.g. "eval _ _" for all evaluation goals: the most specific form of rule conclusion the goal fits in. The top
+    # level of a goal extends into its first argument when that is an application, so every split of the left spine
+    # of the goal is tried
+    def get_predicate(self, goal_expr):
+        best_predicate, best_matched = None, -1
+        elems = []
+        e = goal_expr
+        while True:
+            elems.insert(0, e)
+            for predicate in self.predicates:
+                if len(predicate) == len(elems) and all(name == "_" or isinstance(elem, Constant) and elem.name == name
+                                                        for name, elem in zip(predicate, elems)):
+                    matched = len(predicate) - predicate.count("_")
+                    if matched > best_matched:
+                        best_predicate, best_matched = predicate, matched
+
+            if not isinstance(e, Application):
+                break
 
-            self.rules_by_constant_in_front[constant_in_front].append(rule)
+            elems[0] = e.elems[1]
+            e = e.elems[0]
 
-        constant_in_second_place = get_constant_in_second_place(rule.conclusion)
-        if constant_in_second_place:
-            if constant_in_second_place not in self.rules_by_constant_in_second_place:
-                self.rules_by_constant_in_second_place[constant_in_second_place] = []
+        if best_predicate is None:
+            best_predicate = self.get_top_level_names(goal_expr)
 
-            self.rules_by_constant_in_second_place[constant_in_second_place].append(rule)
+        return " ".join(best_predicate)
 
-        self.rules_by_name[rule.name] = rule
-        self.rules_in_order.append(rule)
-        return rule
+    # identifies the rules independently of the process that loaded them, so results stored on disk for a goal hash
+    # are only reused with the same rules
+    def fingerprint(self):
+        h = 0
+        for rule in self.rules_in_order:
+            h = hashes.combine_hashes(h, get_list_hash([rule.name, rule.conclusion] + rule.premises))
+
+        return h
+
+    # a rule is hashed with the names of the rules tried before it for the goals its conclusion unifies with, since
+    # the order of the rules decides the first answers of depth-first proofs
+    def rule_hashes(self):
+        rule_hashes = {}
+        for rule in self.rules_in_order:
+            rules_before = []
+            for other in self.rules_by_conclusion.find_unifiable(rule.conclusion):
+                if other is rule:
+                    break
+
+                if other.conclusion.unify(rule.conclusion) is not None:
+                    rules_before.append(other.name)
+
+            rule_hashes[rule.name] = get_list_hash([rule.conclusion] + rule.premises), tuple(rules_before)
 
-    def get_applicable_rules(self, goal_expr):
-        rule_set = []
-        constant_in_front = get_constant_in_front(goal_expr)
-        if constant_in_front and constant_in_front in self.rules_by_constant_in_front:
-            rule_set = self.rules_by_constant_in_front[constant_in_front]
+        return rule_hashes
 
-        constant_in_second_place = get_constant_in_second_place(goal_expr)
-        if constant_in_second_place and constant_in_second_place in self.rules_by_constant_in_second_place:
-            rule_set.extend(self.rules_by_constant_in_second_place[constant_in_second_place])
+    # what RulesChange compares the rules with once they are compiled again
+    def snapshot(self):
+        return dict(self.rules_by_name), self.rule_hashes()
 
-        if not constant_in_front and not constant_in_second_place:
-            rule_set = self.rules_in_order
+    # the rules whose conclusion unifies with goal_expr, in the order they were added, whether their conclusion starts
+    # with a constant or a variable. This order decides the first answer of a depth-first proof
+    def get_applicable_rules(self, goal_expr, profiler=None):
+        rule_set = self.rules_by_conclusion.find_unifiable(goal_expr)
+        self.lookup_stats["lookups"] += 1
+        self.lookup_stats["candidates_pruned"] += len(self.rules_in_order) - len(rule_set)
+        self.lookup_stats["candidates_unified"] += len(rule_set)
 
+        predicate = self.get_predicate(goal_expr) if profiler is not None else None
         for rule in rule_set:
-            subs = rule.unify(goal_expr)
+            if profiler is None:
+                subs = rule.unify(goal_expr)
+            else:
+                start = time.perf_counter()
+                subs = rule.unify(goal_expr)
+                profiler.record_unify(rule, predicate, subs is not None, time.perf_counter() - start)
+
             if subs is not None:
+                self.lookup_stats["unify_successes"] += 1
                 yield subs, rule
 
     def refreshing_substitution(self, vars):
@@ -130,21 +201,13 @@ class Rules:
 
         return refreshing_subs
 
+    # the subtrees without variables, e.g. expanded definitions without free variables, are shared with expr
     def refresh_free_variables(self, expr):
-        refresh = {}
-
-        def refreshing_transform(leaf):
-            if leaf in refresh:
-                return refresh[leaf]
+        if not expr.variables:
+            return expr
 
-            if isinstance(leaf, Variable):
-                new_var = self.introduce_variable(leaf)
-                refresh[leaf] = new_var
-                return new_var
-
-            return leaf
-
-        return expr.transform_leaves(refreshing_transform)
+        refresh = {v: self.introduce_variable(v) for v in sorted(expr.variables, key=lambda v: v.name)}
+        return expr.replace_variables(refresh)
 
     def add_definition(self, name, expr, definition_src):
         if name in self.definitions:
@@ -194,25 +257,115 @@ class Rules:
     def collapse_definitions(self, expr):
         return expr.transform_nodes(self.collapse_node_definition)
 
-    def flatten_definitions(self):
-        for name_1, (expr_1, src_1) in self.definitions.items():
-            if expr_1.contains_leaf(name_1):
-                raise RulesError("def %s is recursive:\n%s" % (name_1, src_1))
+    # the definitions used by each definition, in the order they occur in it
+    def definition_uses(self):
+        uses = {}
+        for name, (expr, src) in self.definitions.items():
+            used = []
+            expr.for_all_leaves(lambda leaf: used.append(leaf) if leaf in self.definitions and leaf not in used
+                                else None)
+            uses[name] = used
+
+        return uses
+
+    # the definitions in an order where each one comes after those it uses, or None if some are recursive
+    def definitions_order(self, uses):
+        order = []
+        # False while the definitions a definition uses are being visited, True once it is in order
+        visited = {}
+        for root in self.definitions:
+            if root in visited:
+                continue
+
+            visited[root] = False
+            stack = [(root, iter(uses[root]))]
+            while stack:
+                name, used = stack[-1]
+                for used_name in used:
+                    if used_name not in visited:
+                        visited[used_name] = False
+                        stack.append((used_name, iter(uses[used_name])))
+                        break
+
+                    if not visited[used_name]:
+                        return None
+                else:
+                    stack.pop()
+                    visited[name] = True
+                    order.append(name)
+
+        return order
+
+    # the recursive definition reported when the definitions were expanded one after the other in the order they
+    # were added: the first one that uses itself through definitions added before it
+    def first_recursive_definition(self, uses):
+        index = {name: i for i, name in enumerate(self.definitions)}
+        for name in self.definitions:
+            to_visit = list(uses[name])
+            seen = set()
+            while to_visit:
+                used_name = to_visit.pop()
+                if used_name is name:
+                    return name
+
+                if used_name not in seen and index[used_name] < index[name]:
+                    seen.add(used_name)
+                    to_visit.extend(uses[used_name])
 
-            def expand_def(leaf):
-                if leaf is name_1:
-                    return self.refresh_free_variables(expr_1)
+        return None
 
-                return leaf
+    # each definition is expanded once, after the definitions it uses, which are already expanded and are
+    # substituted with their free variables refreshed at every occurrence
+    def flatten_definitions(self):
+        uses = self.definition_uses()
+        order = self.definitions_order(uses)
+        if order is None:
+            name = self.first_recursive_definition(uses)
+            raise RulesError("def %s is recursive:\n%s" % (name, self.definitions[name][1]))
 
-            for name_2, (expr_2, src_2) in self.definitions.items():
-                expanded_expr_2 = expr_2.transform_leaves(expand_def)
-                self.definitions[name_2] = expanded_expr_2, src_2
+        for name in order:
+            expr, src = self.definitions[name]
+            self.definitions[name] = self.expand_definition_with_variables(expr), src
 
         for rule in self.rules_in_order:
             rule.conclusion = self.expand_definition_with_variables(rule.conclusion)
             rule.premises = list(map(self.expand_definition_with_variables, rule.premises))
 
+        self.rebuild_index()
+
+
+# The rules that changed between a snapshot of the rules (see Rules.snapshot) and the current ones, and the goals whose
+# results may have changed with them. The rules added, removed or changed are affected, and so are the rules with a
+# premise that an affected rule applies to. A goal is affected if an affected rule applies to it, in its current
+# version or in the one of the snapshot
+class RulesChange:
+    def __init__(self, rules_db, snapshot):
+        old_rules, old_hashes = snapshot
+        new_hashes = rules_db.rule_hashes()
+        self.changed = set(name for name in old_hashes.keys() | new_hashes.keys()
+                           if old_hashes.get(name) != new_hashes.get(name))
+        self.affected = set()
+        # the conclusions of the affected rules
+        self.conclusions = DiscriminationTree()
+        for name in self.changed:
+            if name in old_rules:
+                self.conclusions.add(old_rules[name].conclusion, old_rules[name].conclusion)
+
+        grown = True
+        while grown:
+            grown = False
+            for rule in rules_db.rules_in_order:
+                if rule.name not in self.affected and \
+                        (rule.name in self.changed or any(self.affects(p) for p in rule.premises)):
+                    self.affected.add(rule.name)
+                    self.conclusions.add(rule.conclusion, rule.conclusion)
+                    grown = True
+
+        self.affected |= self.changed
+
+    def affects(self, goal):
+        return any(conclusion.unify(goal) is not None for conclusion in self.conclusions.find_unifiable(goal))
+
 
 class VarProcessor:
     def __init__(self, rules):
@@ -233,6 +386,9 @@ class VarProcessor:
 
 
 class Rule:
+    # answers derived with the rule can be stored in tables and reused by later calls
+    tabled = True
+
     def __init__(self, premises, conclusion, name, definition_src, rules):
         self.name = name
         self.definition_src = definition_src
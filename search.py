@@ -1,6 +1,22 @@
+import collections
+import heapq
+
+
+# search nodes are (vertex, parent node) pairs, so a path shares its prefix with the paths of its siblings and is
+# only spelled out when a goal is found
+def node_path(node):
+    path = []
+    while node is not None:
+        vertex, node = node
+        path.append(vertex)
+
+    path.reverse()
+    return path
+
+
 # does not check for loops. Always returns failure path
 def depth_first_search(start, gen_neighbors, is_goal, steps_budget=None):
-    stack = [(start, [start])]
+    stack = [(start, None)]
     steps_taken = 0
     while stack:
         steps_taken += 1
@@ -9,14 +25,106 @@ def depth_first_search(start, gen_neighbors, is_goal, steps_budget=None):
                 yield steps_taken, None
                 return
 
-        (vertex, path) = stack.pop()
+        node = stack.pop()
         new_neighbors = []
-        for neighbor in gen_neighbors(vertex):
+        for neighbor in gen_neighbors(node[0]):
             if is_goal(neighbor):
-                yield steps_taken, path + [neighbor]
+                yield steps_taken, node_path((neighbor, node))
             else:
-                new_neighbors.append((neighbor, path + [neighbor]))
+                new_neighbors.append((neighbor, node))
 
         stack.extend(reversed(new_neighbors))
 
     yield steps_taken, None
+
+
+def breadth_first_search(start, gen_neighbors, is_goal, steps_budget=None):
+    queue = collections.deque([(start, None)])
+    steps_taken = 0
+    while queue:
+        steps_taken += 1
+        if steps_budget is not None:
+            if steps_taken >= steps_budget:
+                yield steps_taken, None
+                return
+
+        node = queue.popleft()
+        for neighbor in gen_neighbors(node[0]):
+            if is_goal(neighbor):
+                yield steps_taken, node_path((neighbor, node))
+            else:
+                queue.append((neighbor, node))
+
+    yield steps_taken, None
+
+
+# depth-first search limited to a depth that doubles with every iteration, so the work repeated by the earlier
+# iterations is at most the work of the last one. Every iteration finds the goals of the earlier ones again, and
+# cannot tell them by their depth: the neighbors of a vertex may change between iterations (the prover skips goals
+# proven by earlier iterations), so a goal is not always found at the same depth. With key, a function of the goal
+# vertices, an iteration leaves out as many goals of each key as an earlier iteration has reported; without it, every
+# iteration reports all the goals it finds
+def iterative_deepening_search(start, gen_neighbors, is_goal, steps_budget=None, key=None):
+    steps_taken = 0
+    depth_limit = 1
+    reported = collections.Counter()
+    while True:
+        stack = [(start, None, 0)]
+        cut_off = False
+        found = collections.Counter()
+        while stack:
+            steps_taken += 1
+            if steps_budget is not None:
+                if steps_taken >= steps_budget:
+                    yield steps_taken, None
+                    return
+
+            vertex, parent, depth = stack.pop()
+            node = vertex, parent
+            new_neighbors = []
+            for neighbor in gen_neighbors(vertex):
+                if is_goal(neighbor):
+                    if key is None:
+                        yield steps_taken, node_path((neighbor, node))
+                        continue
+
+                    goal_key = key(neighbor)
+                    found[goal_key] += 1
+                    if found[goal_key] > reported[goal_key]:
+                        yield steps_taken, node_path((neighbor, node))
+                elif depth + 1 == depth_limit:
+                    cut_off = True
+                else:
+                    new_neighbors.append((neighbor, node, depth + 1))
+
+            stack.extend(reversed(new_neighbors))
+
+        if not cut_off:
+            yield steps_taken, None
+            return
+
+        reported |= found
+        depth_limit *= 2
+
+
+# expands the open vertex with the lowest cost first; among vertices of equal cost the most recently generated one
+def best_first_search(start, gen_neighbors, is_goal, cost, steps_budget=None):
+    generated = 0
+    heap = [(cost(start), 0, (start, None))]
+    steps_taken = 0
+    while heap:
+        steps_taken += 1
+        if steps_budget is not None:
+            if steps_taken >= steps_budget:
+                yield steps_taken, None
+                return
+
+        _, _, node = heapq.heappop(heap)
+        for neighbor in gen_neighbors(node[0]):
+            if is_goal(neighbor):
+                yield steps_taken, node_path((neighbor, node))
+            else:
+                generated += 1
+                heapq.heappush(heap, (cost(neighbor), -generated, (neighbor, node)))
+
+    yield steps_taken, None
@@ -0,0 +1,216 @@
+import sys
+import os
+import json
+import contextlib
+import argparse
+import socketserver
+from compiler import CompilerError
+from rules import RulesError
+from lexer import RuleParseError
+from goviaji import Goviaji
+from evaluation import Evaluator
+import prover
+
+
+class RequestError(Exception):
+    pass
+
+
+# Answers newline-delimited JSON requests about goviaji systems. The systems are compiled on their first request and
+# kept, with their prover caches, keyed by the absolute path of their root file. A request is an object with:
+#   "op": one of the keys of GoviajiServer.operations
+#   "file": the root file of the system
+#   "expr": the term of syntax_check, value_check, eval_step and evaluate
+#   "goals": the list of goals of query, whose variables are shared between them
+#   "id": optional, copied to the response
+# A response has "ok" set to true and the results of the operation, or to false and an "error" message. Terms in
+# responses are written with their definitions collapsed
+class GoviajiServer:
+    # proof_cache_file is an sqlite file shared by all the systems, the results of which are kept apart by the
+    # fingerprints of the rules. use_module_cache is passed on to the Goviaji of each system
+    def __init__(self, search_strategy="dfs", proof_cache_file=None, use_module_cache=True):
+        self.search_strategy = search_strategy
+        self.proof_cache_file = proof_cache_file
+        self.use_module_cache = use_module_cache
+        self.systems = {}
+        self.operations = {
+            "load": self.load,
+            "unload": self.unload,
+            "syntax_check": self.syntax_check,
+            "value_check": self.value_check,
+            "eval_step": self.eval_step,
+            "evaluate": self.evaluate,
+            "query": self.query,
+        }
+
+    def get_system(self, request):
+        file_name = os.path.abspath(get_field(request, "file"))
+        if file_name not in self.systems:
+            # stdout may be the channel of the responses
+            with contextlib.redirect_stdout(sys.stderr):
+                goviaji = Goviaji(file_name, self.proof_cache_file, self.use_module_cache)
+
+            goviaji.search_strategy = self.search_strategy
+            goviaji.evaluator = Evaluator(goviaji)
+            self.systems[file_name] = goviaji
+
+        return self.systems[file_name]
+
+    @staticmethod
+    def get_term(goviaji, request):
+        return goviaji.compiler.rules_db.instantiate_definitions(goviaji.str_to_expression(get_field(request, "expr")))
+
+    @staticmethod
+    def term_to_str(goviaji, expr):
+        return goviaji.compiler.rules_db.collapse_definitions(expr).to_str()
+
+    def load(self, request):
+        goviaji = self.get_system(request)
+        return {"outputs": [name.name for name in goviaji.compiler.expressions_to_print.keys()]}
+
+    # the next request on the file compiles it again
+    def unload(self, request):
+        return {"unloaded": self.systems.pop(os.path.abspath(get_field(request, "file")), None) is not None}
+
+    def syntax_check(self, request):
+        goviaji = self.get_system(request)
+        if not goviaji.syntax_predicate_name:
+            raise RequestError("rules have no predicate \"term\"")
+
+        steps, result = goviaji.syntax_check(self.get_term(goviaji, request))
+        return {"steps": steps, "result": result}
+
+    def value_check(self, request):
+        goviaji = self.get_system(request)
+        if not goviaji.value_predicate_name:
+            raise RequestError("rules have no predicate \"value\"")
+
+        steps, result = goviaji.value_check(self.get_term(goviaji, request))
+        return {"steps": steps, "result": result}
+
+    def eval_step(self, request):
+        goviaji = self.get_system(request)
+        if not goviaji.eval_predicate_name:
+            raise RequestError("rules have no predicate \"eval\"")
+
+        steps, result = goviaji.eval_step(self.get_term(goviaji, request))
+        return {"steps": steps, "result": None if result is None else self.term_to_str(goviaji, result)}
+
+    # evaluates the term until it is a value or stuck, with the evaluator of the system, which keeps its memo
+    # between requests. "terms" lists the term and the result of every eval step
+    def evaluate(self, request):
+        goviaji = self.get_system(request)
+        if not goviaji.eval_predicate_name:
+            raise RequestError("rules have no predicate \"eval\"")
+
+        terms = []
+        total_steps = 0
+        final_state = None
+        for steps, expr, state in goviaji.evaluator.evaluate(self.get_term(goviaji, request)):
+            total_steps += steps
+            final_state = state
+            terms.append(self.term_to_str(goviaji, expr))
+
+        return {"steps": total_steps, "terms": terms, "value": final_state == "value", "stuck": final_state == "stuck"}
+
+    # the answers to the goals, as the values of their variables by name (see Goviaji.query). The optional
+    # "max_answers", "steps_budget" and "time_limit" fields limit the search
+    def query(self, request):
+        goviaji = self.get_system(request)
+        goal_strings = get_field(request, "goals")
+        if not isinstance(goal_strings, list) or not goal_strings:
+            raise RequestError("\"goals\" must be a non-empty list of strings")
+
+        answers = []
+        for subs in goviaji.query(goal_strings, request.get("max_answers"), request.get("steps_budget"),
+                                  request.get("time_limit")):
+            answers.append({var.name: self.term_to_str(goviaji, value) for var, value in subs.items()})
+
+        return {"answers": answers}
+
+    def handle(self, request):
+        response = {}
+        try:
+            if not isinstance(request, dict):
+                raise RequestError("a request must be a JSON object")
+
+            if "id" in request:
+                response["id"] = request["id"]
+
+            op = get_field(request, "op")
+            if op not in self.operations:
+                raise RequestError("unknown operation %s" % op)
+
+            response.update(self.operations[op](request))
+            response["ok"] = True
+        except (RequestError, CompilerError, RulesError, RuleParseError) as err:
+            response["ok"] = False
+            response["error"] = err.args[0]
+        except Exception as err:
+            # e.g. the parser failing on unbalanced parentheses. The server keeps going
+            response["ok"] = False
+            response["error"] = "%s: %s" % (type(err).__name__, err)
+
+        return response
+
+    def handle_line(self, line):
+        try:
+            request = json.loads(line)
+        except ValueError as err:
+            return json.dumps({"ok": False, "error": "invalid JSON: %s" % err})
+
+        return json.dumps(self.handle(request))
+
+    # answers the requests read from the text stream inp on out, one line each, until inp ends
+    def serve(self, inp, out):
+        for line in inp:
+            if not line.strip():
+                continue
+
+            print(self.handle_line(line), file=out, flush=True)
+
+
+def get_field(request, name):
+    if name not in request:
+        raise RequestError("missing field \"%s\"" % name)
+
+    return request[name]
+
+
+# the connections are served one at a time, by the process keeping the systems
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            line = line.decode("utf-8")
+            if not line.strip():
+                continue
+
+            self.wfile.write((self.server.goviaji_server.handle_line(line) + "\n").encode("utf-8"))
+            self.wfile.flush()
+
+
+def serve_socket(goviaji_server, socket_path):
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    with socketserver.UnixStreamServer(socket_path, RequestHandler) as socket_server:
+        socket_server.goviaji_server = goviaji_server
+        socket_server.serve_forever()
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description="Answer JSON requests about goviaji systems, one per line")
+    arg_parser.add_argument("--socket", metavar="PATH", help="Unix socket to listen on instead of stdin")
+    arg_parser.add_argument("--strategy", default="dfs",
+                            choices=list(prover.search_strategies.keys()) + ["tabled", "trail"],
+                            help="proof search strategy")
+    arg_parser.add_argument("--proof-cache", metavar="FILE", help="sqlite file keeping proof results between runs")
+    arg_parser.add_argument("--no-module-cache", action="store_true",
+                            help="compile every file instead of loading the unchanged ones from their cache folder")
+    args = arg_parser.parse_args()
+
+    server = GoviajiServer(args.strategy, args.proof_cache, not args.no_module_cache)
+    if args.socket:
+        serve_socket(server, args.socket)
+    else:
+        server.serve(sys.stdin, sys.stdout)
@@ -16,6 +16,10 @@ class Substitution:
         if not self.replacements:
             return expr
 
+        # generated constants can be renamed too (see tabling), but they are not in the variable sets of expressions
+        if all(var.variables for var in self.replacements):
+            return expr.replace_variables(self.replacements)
+
         return expr.transform_leaves(self.transform)
 
     def compose(self, subs, add=True):
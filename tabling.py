@@ -0,0 +1,232 @@
+from substitution import Substitution
+from expressions import Application, Variable
+
+
+class OutOfSteps(Exception):
+    pass
+
+
+# variables and generated constants of expr in the order of their first occurrence. Expression.get_hash numbers them
+# in the same order, so the leaves of two variants correspond position by position
+def variant_leaves(expr):
+    leaves = []
+    seen = set()
+    to_visit = [expr]
+    while to_visit:
+        e = to_visit.pop()
+        if e.closed:
+            continue
+
+        if isinstance(e, Application):
+            to_visit.append(e.elems[1])
+            to_visit.append(e.elems[0])
+        elif e not in seen:
+            seen.add(e)
+            leaves.append(e)
+
+    return leaves
+
+
+class AnswerTable:
+    def __init__(self, goal):
+        self.goal = goal
+        self.leaves = variant_leaves(goal)
+        self.ground = goal.is_ground()
+        self.answers = []
+        self.answer_hashes = set()
+        self.complete = False
+        self.reusable = True
+        self.on_stack = False
+        self.consumed_incomplete = False
+        self.dfn = None
+        self.link = None
+
+    def add_answer(self, answer):
+        h = answer.get_hash()
+        if h in self.answer_hashes:
+            return False
+
+        self.answer_hashes.add(h)
+        self.answers.append(answer)
+        return True
+
+
+# Tabled resolution: every call to a goal is answered from a table keyed by the variant hash of the goal, so each
+# variant is resolved only once and a call to a variant that is still being resolved (e.g. through a left-recursive
+# rule) consumes the answers found so far instead of recursing. Tables that depend on each other are re-evaluated
+# by the oldest of them (the leader) until no new answers appear, then they are all marked complete.
+# Complete tables are kept in `tables` and can be shared between proofs.
+class TablingProver:
+    def __init__(self, rules, tables, steps_budget=None, verbose=False):
+        self.rules = rules
+        self.tables = tables
+        self.steps_budget = steps_budget
+        self.verbose = verbose
+        self.steps_taken = 0
+        self.next_dfn = 0
+        self.stack = []
+        self.incomplete = []
+        self.recompute = False
+
+    def take_step(self):
+        self.steps_taken += 1
+        if self.steps_budget is not None and self.steps_taken >= self.steps_budget:
+            raise OutOfSteps()
+
+    def solve(self, goal):
+        h = goal.get_hash()
+        table = self.tables.get(h)
+        if table is None:
+            table = AnswerTable(goal)
+            self.tables[h] = table
+            self.evaluate(table)
+        elif not table.complete and not table.on_stack:
+            self.evaluate(table)
+
+        if not table.complete and self.stack:
+            # the answers may still grow, so the caller has to be re-evaluated together with the leader's tables
+            table.consumed_incomplete = True
+            caller = self.stack[-1]
+            caller.link = min(caller.link, table.link)
+
+        return self.instantiate_answers(table, goal)
+
+    def instantiate_answers(self, table, goal):
+        renaming = Substitution()
+        if goal is not table.goal:
+            for table_leaf, goal_leaf in zip(table.leaves, variant_leaves(goal)):
+                if table_leaf is not goal_leaf:
+                    renaming.replace(table_leaf, goal_leaf)
+
+        answers = []
+        for answer in table.answers:
+            local_vars = answer.variables - table.goal.variables
+            if not renaming and not local_vars:
+                answers.append(answer)
+                continue
+
+            answer_renaming = Substitution()
+            answer_renaming.replacements = dict(renaming.replacements)
+            for v in local_vars:
+                answer_renaming.replace(v, self.rules.introduce_variable(v))
+
+            answers.append(answer_renaming.apply(answer))
+
+        return answers
+
+    def evaluate(self, table):
+        if self.verbose:
+            print("Evaluating table of \"%s\"" % table.goal.to_str())
+
+        table.dfn = table.link = self.next_dfn
+        self.next_dfn += 1
+        table.on_stack = True
+        self.stack.append(table)
+        if table not in self.incomplete:
+            self.incomplete.append(table)
+
+        outer_recompute = self.recompute
+        while True:
+            self.recompute = False
+            self.resolve_clauses(table)
+            if table.complete or table.link < table.dfn or not self.recompute:
+                break
+
+            if self.verbose:
+                print("Re-evaluating tables from \"%s\" to reach a fixpoint" % table.goal.to_str())
+
+        self.stack.pop()
+        table.on_stack = False
+
+        if table.link == table.dfn:
+            # table is the leader of its dependent tables, which are now complete
+            for t in self.incomplete[self.incomplete.index(table):]:
+                self.complete(t)
+
+            self.incomplete = [t for t in self.incomplete if not t.complete]
+            self.recompute = outer_recompute
+        else:
+            self.recompute = outer_recompute or self.recompute
+
+    def complete(self, table):
+        table.complete = True
+        if self.verbose:
+            print("Table of \"%s\" complete with %d answers" % (table.goal.to_str(), len(table.answers)))
+
+        if not table.reusable and self.tables.get(table.goal.get_hash()) is table:
+            del self.tables[table.goal.get_hash()]
+
+    def resolve_clauses(self, table):
+        for new_subs, rule in self.rules.get_applicable_rules(table.goal):
+            self.take_step()
+            if self.verbose:
+                print("\tRule %s is applicable with substitution [%s]" % (rule.name, new_subs))
+
+            if not rule.tabled:
+                table.reusable = False
+
+            head = new_subs.apply(table.goal)
+            premises = list(map(new_subs.apply, rule.premises))
+            new_vars = head.collect_variables()
+            for p in premises:
+                p.collect_variables(new_vars)
+
+            refresh_subs = self.rules.refreshing_substitution(new_vars & rule.variables)
+            for terms in self.resolve_conjunction((refresh_subs.apply(head),), list(map(refresh_subs.apply, premises))):
+                if table.add_answer(terms[0]):
+                    if self.verbose:
+                        print("\tNew answer for \"%s\": %s" % (table.goal.to_str(), terms[0].to_str()))
+
+                    if table.consumed_incomplete:
+                        self.recompute = True
+
+                    # a ground goal has only one possible answer
+                    if table.ground:
+                        self.complete(table)
+                        return
+
+    # yields the instances of terms for every solution of the goals, depth first
+    def resolve_conjunction(self, terms, goals):
+        to_visit = [(terms, goals)]
+        while to_visit:
+            terms, goals = to_visit.pop()
+            if not goals:
+                yield terms
+                continue
+
+            first_goal = goals[0]
+            continuations = []
+            for answer in self.solve(first_goal):
+                answer_subs = first_goal.unify(answer)
+                continuations.append((tuple(map(answer_subs.apply, terms)), list(map(answer_subs.apply, goals[1:]))))
+
+            to_visit.extend(reversed(continuations))
+
+
+def prove_tabled(rules, proposition, steps_budget=None, tables=None, verbose=False):
+    if verbose:
+        print("Starting tabled proof of \"%s\"" % ", ".join(p.to_str() for p in proposition))
+
+    if tables is None:
+        tables = {}
+
+    vars_in_proposition = []
+    for e in proposition:
+        vars_in_proposition.extend(v for v in e.variables if v not in vars_in_proposition)
+
+    prover = TablingProver(rules, tables, steps_budget, verbose)
+    try:
+        for values in prover.resolve_conjunction(tuple(vars_in_proposition), proposition):
+            subs = Substitution()
+            for var, value in zip(vars_in_proposition, values):
+                if value is not var:
+                    subs.replace(var, value)
+
+            yield prover.steps_taken, subs
+    except OutOfSteps:
+        # answers of the tables that were not completed may be missing
+        for h, table in list(tables.items()):
+            if not table.complete:
+                del tables[h]
+
+    yield prover.steps_taken, None
@@ -1,8 +1,28 @@
 import unittest
-from goviaji import Goviaji
+from goviaji import Goviaji, run_file, run_output
 from compiler import Compiler, CompilerError
 import rules
+import prover
+import search
+import lexer
+import compiler
+from proof_cache import ProofCache
+from profiler import ProofProfiler
+from flamegraph import StackRecorder
+from server import GoviajiServer
+from evaluation import Evaluator
+from discrimination_tree import DiscriminationTree
+from expressions import Variable, Constant, Application, Bindings, expression_from_list, interned_applications
+from substitution import Substitution
 import os
+import gc
+import time
+import io
+import glob
+import json
+import re
+import contextlib
+import tempfile
 
 
 def make_goviaji_test_case(file_name, test_cases):
@@ -13,7 +33,7 @@ def make_goviaji_test_case(file_name, test_cases):
     @classmethod
     def setUpClass(self):
         try:
-            self.goviaji = Goviaji(file_name)
+            self.goviaji = Goviaji(file_name, use_module_cache=False)
         except CompilerError as err:
             self.fail("Compilation error: " + err.args[0])
         except rules.RulesError as err:
@@ -98,6 +118,26 @@ def make_goviaji_test_case(file_name, test_cases):
     globals()[test_case_name] = test_class
 
 
+# what run_output prints for the outputs of the file, evaluated for at most max_eval_steps steps, without the step
+# counts and with the generated names numbered alike. The evaluator does not check whether the terms it can reduce
+# are values
+def run_outputs(file_name, max_eval_steps, search_strategy="dfs", eval_driver=False):
+    with contextlib.redirect_stdout(io.StringIO()):
+        goviaji = Goviaji(file_name, use_module_cache=False)
+
+    goviaji.max_eval_steps = max_eval_steps
+    goviaji.search_strategy = search_strategy
+    if eval_driver:
+        goviaji.evaluator = Evaluator(goviaji)
+
+    out = io.StringIO()
+    for name, (expr, src) in goviaji.compiler.expressions_to_print.items():
+        run_output(goviaji, name, expr, out)
+
+    text = re.sub(r"not value \[[0-9]+ steps[^]]*\], ", "", out.getvalue())
+    return re.sub(r"_[0-9]+", "_N", re.sub(r"\[[0-9]+ steps[^]]*\]", "", text))
+
+
 make_goviaji_test_case("systems/untyped_arithmetic/b_tests.goviaji",
                        {"simple":"SYNTAX_OK;NOT_VALUE;true;NORMAL;VALUE",
                         "double":"SYNTAX_OK;if true then (if false then false else false) else true;"
@@ -226,5 +266,858 @@ make_goviaji_test_case("systems/untyped_lambda/lambda_nb_tests.goviaji",
                         "rn_2": "SYNTAX_OK;STEP_21;4;NORMAL;VALUE"})
 
 
+class LexerTest(unittest.TestCase):
+    @staticmethod
+    def tokens_or_error(tokenize_function, text):
+        try:
+            return [(t.type, t.string, t.loc) for t in tokenize_function(text).tokens]
+        except lexer.RuleParseError as err:
+            return err.args[0]
+
+    def test_same_tokens(self):
+        texts = ["a->b :- X1_y, 12 _a  ", "12_a (b)", "x # comment -> (", "((a))->(b)=>(", "a -- > b\n\t c:-d\n",
+                 "A\u2192B  -\u2192 \u00e9a", "\x1ca\x1fb\x0b", "12a", "a\x01b", "x\x7f"]
+        for file_name in glob.glob("systems/*/*.goviaji"):
+            with open(file_name) as f:
+                texts.append(f.read())
+
+        for text in texts:
+            self.assertEqual(self.tokens_or_error(lexer.tokenize, text),
+                             self.tokens_or_error(lexer.tokenize_by_char, text), text[:40])
+
+
+def compile_source(source):
+    with tempfile.TemporaryDirectory() as folder:
+        file_name = os.path.join(folder, "rules.goviaji")
+        with open(file_name, "w") as f:
+            f.write(source)
+
+        compiler = Compiler()
+        compiler.compile_file(file_name)
+        return compiler.rules_db
+
+
+class RuleSplittingTest(unittest.TestCase):
+    def test_premises(self):
+        premises = ", ".join("q (c%d X)" % i for i in range(300))
+        rules_db = compile_source("rule r1 = p X :- %s,\nrule r2 = p a :-\nrule r3 = q b\n" % premises)
+        self.assertEqual([len(rule.premises) for rule in rules_db.rules_in_order[-3:]], [300, 0, 0])
+
+    def test_errors(self):
+        for source, message in [("rule r = :- q X", "rule with an empty head"),
+                                ("rule r = p X :- q X, , q a", "empty premise in rule"),
+                                ("rule r = p X :- q X :- q a", "second turnstile in rule")]:
+            with self.assertRaises(CompilerError) as context:
+                compile_source(source)
+
+            self.assertIn(message, context.exception.args[0])
+            self.assertIn(source, context.exception.args[0])
+
+
+class FlattenDefinitionsTest(unittest.TestCase):
+    def test_recursive(self):
+        for source, recursive_def in [("def a = f a", "a"),
+                                      ("def x = h y\ndef a = f b\ndef b = g a\ndef y = k x", "b"),
+                                      ("def c = f a\ndef a = f b\ndef b = g c", "b")]:
+            rules_db = compile_source(source)
+            with self.assertRaises(rules.RulesError) as context:
+                rules_db.flatten_definitions()
+
+            self.assertTrue(context.exception.args[0].startswith("def %s is recursive:\n" % recursive_def))
+            self.assertIn("def %s =" % recursive_def, context.exception.args[0])
+
+    def test_expansion(self):
+        rules_db = compile_source("def c = pair b b\ndef b = pair a a\ndef a = f X\nrule r = p c")
+        rules_db.flatten_definitions()
+        expanded = rules_db.rules_in_order[-1].conclusion
+        self.assertEqual(re.sub(r"\$\d+", "", expanded.to_str()), "p (pair (pair (f X) (f X)) (pair (f X) (f X)))")
+        self.assertEqual(len(expanded.variables), 4)
+
+
+class ModuleCacheTest(unittest.TestCase):
+    @staticmethod
+    def compile_quietly(file_name):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            compiler = Compiler()
+            compiler.compile_file(file_name)
+
+        compiled = [line for line in out.getvalue().splitlines() if line.startswith("Compiling")]
+        return [rule.to_str() for rule in compiler.rules_db.rules_in_order], compiled
+
+    def test_reload(self):
+        with tempfile.TemporaryDirectory() as folder:
+            main_file = os.path.join(folder, "main.goviaji")
+            lib_file = os.path.join(folder, "lib.goviaji")
+            with open(main_file, "w") as f:
+                f.write("import lib\nrule r1 = p X :- q X\ndef d = f X Y\nprint o = d\n")
+
+            with open(lib_file, "w") as f:
+                f.write("rule r2 = q a\n")
+
+            rules_1, compiled_1 = self.compile_quietly(main_file)
+            rules_2, compiled_2 = self.compile_quietly(main_file)
+            self.assertEqual(compiled_1, ["Compiling main.goviaji...", "Compiling lib.goviaji..."])
+            self.assertEqual(compiled_2, [])
+            self.assertEqual(rules_1, rules_2)
+
+            with open(lib_file, "w") as f:
+                f.write("rule r2 = q b\n")
+
+            rules_3, compiled_3 = self.compile_quietly(main_file)
+            self.assertEqual(compiled_3, ["Compiling lib.goviaji..."])
+            self.assertEqual(rules_3[-2], "rule r2 = q b")
+
+            with open(compiler.module_cache_file(main_file), "wb") as f:
+                f.write(b"not a module")
+
+            self.assertEqual(self.compile_quietly(main_file), (rules_3, ["Compiling main.goviaji..."]))
+
+
+class ReloadTest(unittest.TestCase):
+    def test_reload(self):
+        with tempfile.TemporaryDirectory() as folder:
+            main_file = os.path.join(folder, "main.goviaji")
+            lib_file = os.path.join(folder, "lib.goviaji")
+            with open(main_file, "w") as f:
+                f.write("import lib\nrule r1 = p X :- q X\nprint o = p a\n")
+
+            with open(lib_file, "w") as f:
+                f.write("rule r2 = q a\nrule r3 = s b\n")
+
+            goviaji = Goviaji(main_file)
+            goviaji.prover_cache.goals = {}
+            self.assertEqual(goviaji.reload(), ([], None))
+            self.assertEqual(len(list(goviaji.query("p a"))), 1)
+            self.assertEqual(len(list(goviaji.query("s b"))), 1)
+
+            with open(lib_file, "w") as f:
+                f.write("rule r2 = q c\nrule r3 = s b\n")
+
+            # the modification time may not change within the resolution of the file system
+            mtime = os.stat(lib_file).st_mtime
+            os.utime(lib_file, (mtime + 1, mtime + 1))
+            changed_files, change = goviaji.reload()
+            rules_db = goviaji.compiler.rules_db
+            self.assertEqual(changed_files, [os.path.abspath(lib_file)])
+            self.assertEqual(change.changed, {rules_db.constants["r2"]})
+            self.assertEqual(change.affected, {rules_db.constants["r1"], rules_db.constants["r2"]})
+            self.assertNotIn(goviaji.str_to_expression("p a").get_hash(), goviaji.prover_cache)
+            self.assertIn(goviaji.str_to_expression("s b").get_hash(), goviaji.prover_cache)
+            self.assertEqual(len(list(goviaji.query("p a"))), 0)
+            self.assertEqual(len(list(goviaji.query("p c"))), 1)
+
+    def touch(self, file_name, content):
+        mtime = os.stat(file_name).st_mtime if os.path.exists(file_name) else 0
+        with open(file_name, "w") as f:
+            f.write(content)
+
+        os.utime(file_name, (mtime + 1, mtime + 1))
+
+    def test_failed_reload(self):
+        with tempfile.TemporaryDirectory() as folder:
+            main_file = os.path.join(folder, "main.goviaji")
+            lib_file = os.path.join(folder, "lib.goviaji")
+            self.touch(main_file, "import lib\nrule r1 = p X :- q X\n")
+            self.touch(lib_file, "rule r2 = q a\n")
+
+            goviaji = Goviaji(main_file)
+            goviaji.prover_cache.goals = {}
+            self.assertEqual(len(list(goviaji.query("p a"))), 1)
+
+            self.touch(main_file, "import lib\nrule r1 = p X :- q X\nrule r3 = s b\n")
+            self.touch(lib_file, "rule r2 = q c\nrule r4 = q )\n")
+            with contextlib.redirect_stdout(io.StringIO()):
+                for _ in range(2):
+                    with self.assertRaises(CompilerError):
+                        goviaji.reload()
+
+            rules_db = goviaji.compiler.rules_db
+            self.assertEqual([rule.name.name for rule in rules_db.rules_in_order[-2:]], ["r2", "r1"])
+            self.assertEqual(len(list(goviaji.query("p a"))), 1)
+            self.assertEqual(len(list(goviaji.query("p c"))), 0)
+
+            self.touch(lib_file, "rule r2 = q c\n")
+            changed_files, change = goviaji.reload()
+            self.assertEqual(changed_files, [os.path.abspath(lib_file), os.path.abspath(main_file)])
+            self.assertEqual(change.changed, {rules_db.constants["r2"], rules_db.constants["r3"]})
+            self.assertEqual(len(list(goviaji.query("p a"))), 0)
+            self.assertEqual(len(list(goviaji.query("p c"))), 1)
+            self.assertEqual(len(list(goviaji.query("s b"))), 1)
+
+    # swapping two rules for the same goals changes the first answers, so both are changed
+    def test_rule_order(self):
+        with tempfile.TemporaryDirectory() as folder:
+            main_file = os.path.join(folder, "main.goviaji")
+            self.touch(main_file, "rule r1 = p X :- s X\nrule r2 = p X :- t X\nrule r3 = s a\nrule r4 = t b\n")
+            goviaji = Goviaji(main_file)
+            goviaji.prover_cache.goals = {}
+            self.assertEqual([str(subs) for subs in goviaji.query("p X", max_answers=1)], ["X -> a"])
+
+            self.touch(main_file, "rule r2 = p X :- t X\nrule r1 = p X :- s X\nrule r3 = s a\nrule r4 = t b\n")
+            changed_files, change = goviaji.reload()
+            rules_db = goviaji.compiler.rules_db
+            self.assertEqual(change.changed, {rules_db.constants["r1"], rules_db.constants["r2"]})
+            self.assertEqual([str(subs) for subs in goviaji.query("p X", max_answers=1)], ["X -> b"])
+
+
+class DiscriminationTreeTest(unittest.TestCase):
+    def setUp(self):
+        self.rules_db = rules.Rules()
+        self.c = {name: self.rules_db.add_constant_by_name(name) for name in ["eval", "term", "lambda", "a", "b"]}
+
+    def expr(self, *elems):
+        return expression_from_list([self.c[e] if isinstance(e, str) else e for e in elems])
+
+    def test_find_unifiable(self):
+        tree = DiscriminationTree()
+        tree.add(self.expr("term", self.expr("lambda", Variable("X"))), "term_lambda")
+        tree.add(self.expr("term", self.expr(Variable("T1"), Variable("T2"))), "term_app")
+        tree.add(self.expr("term", Variable("X")), "term_var")
+        tree.add(self.expr("eval", Variable("T1"), Variable("T2")), "eval")
+
+        self.assertEqual(tree.find_unifiable(self.expr("term", "a")), ["term_var"])
+        self.assertEqual(tree.find_unifiable(self.expr("term", self.expr("lambda", "b"))),
+                         ["term_lambda", "term_app", "term_var"])
+        self.assertEqual(tree.find_unifiable(self.expr("term", self.expr("a", "b"))), ["term_app", "term_var"])
+        self.assertEqual(tree.find_unifiable(self.expr("term", Variable("Y"))), ["term_lambda", "term_app", "term_var"])
+        self.assertEqual(tree.find_unifiable(self.expr(Variable("P"), "a")), ["term_var", "eval"])
+        self.assertEqual(tree.find_unifiable(Variable("G")), ["term_lambda", "term_app", "term_var", "eval"])
+        self.assertEqual(tree.find_unifiable(self.expr("eval", "a")), [])
+
+    def test_lookup_does_not_change_index(self):
+        self.rules_db.add_rule(rules.Rule([], self.expr("term", self.expr("lambda", Variable("X"))),
+                                          self.rules_db.add_constant_by_name("term_lambda"), "", self.rules_db))
+        self.rules_db.add_rule(rules.Rule([], self.expr("term", Variable("X")),
+                                          self.rules_db.add_constant_by_name("term_var"), "", self.rules_db))
+
+        goal = self.expr("term", self.expr("lambda", "a"))
+        for _ in range(3):
+            self.assertEqual([rule.name.name for subs, rule in self.rules_db.get_applicable_rules(goal)],
+                             ["term_lambda", "term_var"])
+
+    # candidates come in declaration order, not grouped by the constants of their conclusions
+    def test_candidate_order(self):
+        for name, conclusion in [("term_a", self.expr("term", "a")), ("var_a", self.expr(Variable("X"), "a")),
+                                 ("term_var", self.expr("term", Variable("X"))),
+                                 ("var_b", self.expr(Variable("X"), "b"))]:
+            self.rules_db.add_rule(rules.Rule([], conclusion, self.rules_db.add_constant_by_name(name), "",
+                                              self.rules_db))
+
+        self.assertEqual([rule.name.name for subs, rule in self.rules_db.get_applicable_rules(self.expr("term", "a"))],
+                         ["term_a", "var_a", "term_var"])
+        self.assertEqual([rule.name.name for subs, rule in
+                          self.rules_db.get_applicable_rules(self.expr(Variable("P"), "b"))], ["term_var", "var_b"])
+
+
+class SearchStrategiesTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.goviaji = Goviaji("systems/untyped_arithmetic/nb_branches_first.goviaji", use_module_cache=False)
+
+    def test_strategies(self):
+        expr = self.goviaji.str_to_expression("if (if true then true else false) then false else true")
+        for strategy in list(prover.search_strategies.keys()) + ["tabled", "trail"]:
+            self.goviaji.search_strategy = strategy
+            self.goviaji.prover_cache.clear()
+            steps, syntax_ok = self.goviaji.syntax_check(expr)
+            self.assertTrue(syntax_ok, strategy)
+
+            current_expr = expr
+            for expected in ["if true then false else true", "false"]:
+                steps, current_expr = self.goviaji.eval_step(current_expr)
+                self.assertIs(current_expr, self.goviaji.str_to_expression(expected), strategy)
+
+            steps, is_value = self.goviaji.value_check(current_expr)
+            self.assertTrue(is_value, strategy)
+
+    # the first steps of the outputs of every system, the longer evaluations taking seconds per step
+    def test_trail_answers(self):
+        for file_name in sorted(glob.glob("systems/*/*.goviaji")):
+            self.assertEqual(run_outputs(file_name, 3, "trail"), run_outputs(file_name, 3), file_name)
+
+    def test_trail_options(self):
+        goviaji = Goviaji("systems/untyped_arithmetic/nb_branches_first.goviaji", use_module_cache=False)
+        goviaji.search_strategy = "trail"
+        goal = goviaji.str_to_expression("eval X Y")
+        self.assertEqual(len(list(goviaji.query("eval X Y", max_answers=1, time_limit=60))), 1)
+        with self.assertRaises(prover.ProofTimeout):
+            next(goviaji.prove([goal], deadline=time.perf_counter() - 1))
+
+        goviaji.loop_check = True
+        with self.assertRaises(ValueError):
+            goviaji.prove([goal])
+
+
+class OrParallelTest(unittest.TestCase):
+    def test_same_answers(self):
+        goviaji = Goviaji("systems/untyped_arithmetic/nb_branches_first.goviaji", use_module_cache=False)
+        goviaji.or_parallel_jobs = 2
+        expr = goviaji.str_to_expression("if (if true then true else false) then false else true")
+        for deterministic in [False, True]:
+            goviaji.or_parallel_deterministic = deterministic
+            goviaji.prover_cache.clear()
+            steps, syntax_ok = goviaji.syntax_check(expr)
+            self.assertTrue(syntax_ok)
+
+            current_expr = expr
+            for expected in ["if true then false else true", "false"]:
+                steps, current_expr = goviaji.eval_step(current_expr)
+                self.assertIs(current_expr, goviaji.str_to_expression(expected))
+
+            steps, is_value = goviaji.value_check(current_expr)
+            self.assertTrue(is_value)
+
+            steps, is_value = goviaji.value_check(expr)
+            self.assertFalse(is_value)
+
+        goviaji.close()
+
+    # the pool is kept between the proofs, and only the callers of the first answer use it
+    def test_pool_reused(self):
+        goviaji = Goviaji("systems/untyped_lambda/lambda_nb_tests.goviaji", use_module_cache=False)
+        goviaji.or_parallel_jobs = 2
+        self.assertEqual(len(list(goviaji.query("X in_fv (x (y x))"))), 4)
+        self.assertIsNone(goviaji.or_parallel_pool)
+
+        steps, syntax_ok = goviaji.syntax_check(goviaji.str_to_expression("x (y x)"))
+        self.assertTrue(syntax_ok)
+        pool = goviaji.or_parallel_pool
+        self.assertIsNotNone(pool)
+        steps, syntax_ok = goviaji.syntax_check(goviaji.str_to_expression("x y"))
+        self.assertTrue(syntax_ok)
+        self.assertIs(goviaji.or_parallel_pool, pool)
+
+        goviaji.close()
+        self.assertIsNone(goviaji.or_parallel_pool)
+
+
+class ProofCacheTest(unittest.TestCase):
+    def test_eviction(self):
+        cache = ProofCache(max_entries=2)
+        cache.start_proof()
+        for h in range(4):
+            cache[h] = True
+
+        # entries of the proof in progress are kept over the limit
+        self.assertEqual(len(cache), 4)
+        self.assertEqual(cache.evictions, 0)
+
+        cache.start_proof()
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.evictions, 2)
+        self.assertNotIn(0, cache)
+        self.assertIn(3, cache)
+        self.assertTrue(cache[3])
+
+        # 3 was used more recently than 2
+        cache.start_proof()
+        cache[4] = False
+        cache.start_proof()
+        self.assertIn(3, cache)
+        self.assertNotIn(2, cache)
+        self.assertEqual(cache.stats(), {"entries": 2, "hits": 2, "misses": 2, "evictions": 3, "store_hits": 0})
+
+    # only the goals of the entries are kept, the premises of the branches left untried are not
+    def test_goals(self):
+        with tempfile.TemporaryDirectory() as folder:
+            file_name = os.path.join(folder, "main.goviaji")
+            with open(file_name, "w") as f:
+                f.write("rule r1 = p X :- q X\nrule r2 = q a\nrule r3 = p X :- s X\nrule r4 = s b\n")
+
+            with contextlib.redirect_stdout(io.StringIO()):
+                goviaji = Goviaji(file_name)
+
+            cache = goviaji.prover_cache
+            cache.goals = {}
+            steps, subs = next(goviaji.prove([goviaji.str_to_expression("p X")]))
+            self.assertIsNotNone(subs)
+            self.assertEqual(sorted(goal.to_str() for goal in cache.goals.values()), ["p X", "q X"])
+
+            self.assertEqual(len(list(goviaji.query("p c"))), 0)
+            cache.max_entries = 1
+            cache.start_proof()
+            self.assertEqual(len(cache), 1)
+            self.assertEqual(set(cache.goals), set(cache.entries))
+
+
+class ProofStoreTest(unittest.TestCase):
+    def test_warm_run(self):
+        with tempfile.TemporaryDirectory() as folder:
+            cache_file = os.path.join(folder, "proofs.sqlite")
+            file_name = "systems/untyped_lambda/lambda_tests.goviaji"
+            cold = Goviaji(file_name, cache_file, use_module_cache=False)
+            expr_src = "(lambda x. x) (lambda y. y)"
+            cold_steps, cold_result = cold.eval_step(cold.str_to_expression(expr_src))
+            cold.prover_cache.store.flush()
+
+            warm = Goviaji(file_name, cache_file, use_module_cache=False)
+            warm_steps, warm_result = warm.eval_step(warm.str_to_expression(expr_src))
+            self.assertGreater(cold_steps, 0)
+            self.assertEqual(warm_steps, 0)
+            self.assertEqual(warm_result.to_str(), cold_result.to_str())
+            self.assertEqual(warm.compiler.rules_db.fingerprint(), cold.compiler.rules_db.fingerprint())
+
+    # the first answers depend on the loop check, and on the scheduling of OR-parallel proofs that are not deterministic
+    def test_answer_settings(self):
+        with tempfile.TemporaryDirectory() as folder:
+            goviaji = Goviaji("systems/untyped_lambda/lambda_tests.goviaji", os.path.join(folder, "proofs.sqlite"),
+                              use_module_cache=False)
+            store = goviaji.prover_cache.store
+            expr = goviaji.str_to_expression("(lambda x. x) (lambda y. y)")
+            steps, result = goviaji.eval_step(expr)
+            goal = expression_from_list([goviaji.eval_predicate_name, expr, Variable("Y")])
+            self.assertIs(store.get_answer(goal, "dfs", False), result)
+            self.assertIsNone(store.get_answer(goal, "dfs", True))
+
+            goviaji.or_parallel_jobs = 2
+            goviaji.loop_check = True
+            steps, result = goviaji.eval_step(expr)
+            goviaji.close()
+            self.assertGreater(steps, 0)
+            self.assertIsNone(store.get_answer(goal, "dfs", True))
+            store.flush()
+
+
+class ProfilerTest(unittest.TestCase):
+    def test_eval_profile(self):
+        goviaji = Goviaji("systems/untyped_arithmetic/nb_tests.goviaji", use_module_cache=False)
+        goviaji.profiler = ProofProfiler()
+        steps, result = goviaji.eval_step(goviaji.str_to_expression("pred (succ (pred 0))"))
+        self.assertIsNotNone(result)
+
+        profile = goviaji.profiler.to_dict()
+        self.assertIn("eval _ _", profile["predicates"])
+        self.assertGreater(profile["predicates"]["eval _ _"]["goals"], 0)
+        for counter in ["unify_attempts", "unify_successes", "branches"]:
+            self.assertEqual(sum(stats[counter] for stats in profile["rules"].values()),
+                             sum(stats[counter] for stats in profile["predicates"].values()))
+
+        self.assertIn("eval _ _", goviaji.profiler.report())
+
+    def test_proof_stacks(self):
+        goviaji = Goviaji("systems/untyped_arithmetic/nb_tests.goviaji", use_module_cache=False)
+        expr = goviaji.str_to_expression("pred (succ (pred 0))")
+        steps, result = goviaji.eval_step(expr)
+        goviaji.prover_cache.clear()
+        goviaji.stack_recorder = StackRecorder("eval")
+        self.assertEqual(goviaji.eval_step(expr), (steps, result))
+
+        lines = goviaji.stack_recorder.to_collapsed().splitlines()
+        self.assertTrue(all(line.startswith("eval") for line in lines))
+        self.assertTrue(any(";" in line for line in lines))
+        self.assertEqual(sum(int(line.rsplit(" ", 1)[1]) for line in lines), goviaji.stack_recorder.goals_expanded)
+
+
+class SubstitutionTest(unittest.TestCase):
+    def test_apply(self):
+        x, y = Variable("X"), Variable("Y")
+        a, b = Constant("a"), Constant("b")
+        untouched = expression_from_list([a, y, b])
+        expr = expression_from_list([x, untouched, x])
+
+        subs = Substitution()
+        subs.replace(x, b)
+        self.assertIs(subs.apply(untouched), untouched)
+        self.assertIs(subs.apply(expr), expression_from_list([b, untouched, b]))
+
+        generated = Constant("_1", generated=True)
+        renaming = Substitution()
+        renaming.replace(generated, a)
+        self.assertIs(renaming.apply(expression_from_list([generated, y])), expression_from_list([a, y]))
+
+
+class QueryTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.goviaji = Goviaji("systems/untyped_lambda/lambda_nb_tests.goviaji", use_module_cache=False)
+
+    def answers(self, goals, **limits):
+        return [", ".join("%s -> %s" % (var.name, value.to_str()) for var, value in subs.items())
+                for subs in self.goviaji.query(goals, **limits)]
+
+    def test_all_answers(self):
+        for strategy in list(prover.search_strategies.keys()) + ["tabled", "trail"]:
+            self.goviaji.search_strategy = strategy
+            self.assertEqual(self.answers("X in_fv (x (y x))"), ["X -> x (y x)", "X -> x", "X -> y x", "X -> y"],
+                             strategy)
+
+        self.goviaji.search_strategy = "dfs"
+
+    # the proofs rather than the answers, x being a free variable of x (y x) twice
+    def test_iterative_deepening_answers(self):
+        goal = self.goviaji.str_to_expression("X in_fv (x (y x))")
+        for strategy in ["dfs", "iddfs"]:
+            answers = [str(subs) for steps, subs in prover.prove_dfs(self.goviaji.compiler.rules_db, [goal],
+                                                                     search_strategy=strategy)]
+            self.assertEqual(answers, ["X -> x (y x)", "X -> x", "X -> y x", "X -> y", "X -> x", "None"], strategy)
+
+    def test_limits(self):
+        # x is found twice
+        self.assertEqual(self.answers("X in_fv (x x)"), ["X -> x x", "X -> x"])
+        self.assertEqual(self.answers("X in_fv (x (y x))", max_answers=2), ["X -> x (y x)", "X -> x"])
+        self.assertEqual(self.answers(["X in_fv (x (y x))", "X in_fv (y z)"]), ["X -> y"])
+        self.assertLess(len(self.answers("eval X Y", steps_budget=50)), 50)
+        self.assertEqual(len(self.answers("eval X Y", max_answers=1, time_limit=60)), 1)
+        goal = self.goviaji.str_to_expression("eval X Y")
+        with self.assertRaises(prover.ProofTimeout):
+            next(prover.prove_dfs(self.goviaji.compiler.rules_db, [goal], deadline=time.perf_counter() - 1))
+
+    # a suspended query relies on the results in the cache it has seen, which another proof could evict
+    def test_interleaved_queries(self):
+        answers = self.goviaji.query("X in_fv (x (y x))")
+        next(answers)
+        with self.assertRaises(RuntimeError):
+            next(self.goviaji.query("X in_fv (y x)"))
+
+        with self.assertRaises(RuntimeError):
+            self.goviaji.eval_step(self.goviaji.str_to_expression("x"))
+
+        self.assertEqual(len(list(answers)), 3)
+        self.assertEqual(self.answers("X in_fv (y x)"), ["X -> y x", "X -> y", "X -> x"])
+
+        answers = self.goviaji.query("X in_fv (x (y x))")
+        next(answers)
+        answers.close()
+        self.assertEqual(len(self.answers("X in_fv (y x)")), 3)
+
+
+class EvaluatorTest(unittest.TestCase):
+    @staticmethod
+    def run_quietly(file_name, eval_driver):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            run_file(file_name, eval_driver=eval_driver, use_module_cache=False)
+
+        # the evaluator does not check whether the terms it can reduce are values, and takes fewer proof steps
+        text = re.sub(r"not value \[[0-9]+ steps[^]]*\], ", "", out.getvalue())
+        return re.sub(r"_[0-9]+", "_N", re.sub(r"\[[0-9]+ steps[^]]*\]", "", text))
+
+    def test_same_output(self):
+        for file_name in ["systems/untyped_lambda/lambda_tests.goviaji",
+                          "systems/untyped_arithmetic/nb_big_step.goviaji",
+                          "systems/untyped_arithmetic/nb_with_wrong.goviaji"]:
+            self.assertEqual(self.run_quietly(file_name, False), self.run_quietly(file_name, True), file_name)
+
+    # the first steps of the outputs of every system, the longer evaluations taking seconds per step
+    def test_same_output_all_systems(self):
+        for file_name in sorted(glob.glob("systems/*/*.goviaji")):
+            self.assertEqual(run_outputs(file_name, 10), run_outputs(file_name, 10, eval_driver=True), file_name)
+
+    def test_local_steps(self):
+        goviaji = Goviaji("systems/untyped_lambda/lambda_tests.goviaji", use_module_cache=False)
+        evaluator = Evaluator(goviaji)
+        expr = goviaji.compiler.rules_db.instantiate_definitions(
+            goviaji.str_to_expression("(lambda x. (x id)) ((lambda u. (u u)) id)"))
+        states = [state for steps, expr, state in evaluator.evaluate(expr)]
+        self.assertEqual(states, ["step"] * 4 + ["value"])
+        # id id is reduced at the changed position, after which it and id are found in the memo
+        self.assertEqual(evaluator.stats["local_steps"], 1)
+        self.assertEqual(evaluator.stats["memo_hits"], 2)
+
+    def test_stopped_proof_not_memoised(self):
+        goviaji = Goviaji("systems/untyped_arithmetic/nb_tests.goviaji", use_module_cache=False)
+        evaluator = Evaluator(goviaji)
+        expr = goviaji.str_to_expression("pred (succ (pred 0))")
+        goviaji.proof_steps_budget = 3
+        self.assertEqual(evaluator.eval_term(expr), (3, None))
+        self.assertNotIn(expr.get_hash(), evaluator.memo)
+
+        goviaji.proof_steps_budget = 1000
+        steps, result = evaluator.eval_term(expr)
+        self.assertEqual(result.to_str(), "pred (succ 0)")
+
+
+class ServerTest(unittest.TestCase):
+    def test_requests(self):
+        file_name = "systems/untyped_arithmetic/nb_tests.goviaji"
+        requests = [{"id": 1, "op": "syntax_check", "file": file_name, "expr": "succ (pred 0)"},
+                    {"id": 2, "op": "eval_step", "file": file_name, "expr": "pred (succ (pred 0))"},
+                    {"id": 3, "op": "evaluate", "file": file_name, "expr": "pred (succ (pred 0))"},
+                    {"id": 4, "op": "query", "file": file_name, "goals": ["eval (pred (succ (pred 0))) X", "eval X Y"]},
+                    {"id": 5, "op": "eval_step", "file": file_name}]
+        server = GoviajiServer(use_module_cache=False)
+        out = io.StringIO()
+        with contextlib.redirect_stderr(io.StringIO()):
+            server.serve(io.StringIO("\n".join(map(json.dumps, requests)) + "\nnot json\n"), out)
+
+        responses = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(len(responses), 6)
+        self.assertTrue(responses[0]["result"])
+        self.assertEqual(responses[1]["result"], "pred 1")
+        self.assertEqual(responses[2]["terms"], ["pred (succ (pred 0))", "pred 1", "0"])
+        self.assertTrue(responses[2]["value"])
+        self.assertEqual(responses[3]["answers"], [{"X": "pred 1", "Y": "0"}])
+        self.assertEqual(responses[4], {"id": 5, "ok": False, "error": "missing field \"expr\""})
+        self.assertFalse(responses[5]["ok"])
+        # the system was compiled once
+        self.assertEqual(list(server.systems.keys()), [os.path.abspath(file_name)])
+
+
+class ParallelRunTest(unittest.TestCase):
+    @staticmethod
+    def run_quietly(file_name, jobs):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            run_file(file_name, jobs=jobs, use_module_cache=False)
+
+        # each worker has its own prover cache, so only the step counts and the generated names may differ
+        return re.sub(r"_[0-9]+", "_N", re.sub(r"\[[0-9]+ steps[^]]*\]", "", out.getvalue()))
+
+    def test_same_output(self):
+        file_name = "systems/untyped_arithmetic/nb_tests.goviaji"
+        self.assertEqual(self.run_quietly(file_name, 1), self.run_quietly(file_name, 2))
+
+
+class TablingTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with tempfile.TemporaryDirectory() as folder:
+            file_name = os.path.join(folder, "left_recursion.goviaji")
+            with open(file_name, "w") as f:
+                f.write("rule edge_ab = edge a b\n"
+                        "rule edge_bc = edge b c\n"
+                        "rule edge_ca = edge c a\n"
+                        "rule edge_cd = edge c d\n"
+                        "rule path_step = path X Y :- path X Z, edge Z Y\n"
+                        "rule path_edge = path X Y :- edge X Y\n")
+
+            cls.goviaji = Goviaji(file_name)
+
+        cls.goviaji.search_strategy = "tabled"
+
+    def answers(self, query):
+        goal = self.goviaji.str_to_expression(query)
+        target_var = next(iter(goal.variables))
+        return sorted(subs[target_var].to_str() for steps, subs in self.goviaji.prove([goal]) if subs is not None)
+
+    def test_left_recursion(self):
+        self.assertEqual(self.answers("path a X"), ["a", "b", "c", "d"])
+        self.assertEqual(self.answers("path Y d"), ["a", "b", "c"])
+
+    def test_ground_goal(self):
+        self.assertEqual(len([subs for steps, subs in self.goviaji.prove([self.goviaji.str_to_expression("path d a")])
+                              if subs is not None]), 0)
+
+        steps, subs = next(self.goviaji.prove([self.goviaji.str_to_expression("path b b")]))
+        self.assertIsNotNone(subs)
+
+
+class LongConjunctionTest(unittest.TestCase):
+    def test_ground_goals_without_branching(self):
+        with tempfile.TemporaryDirectory() as folder:
+            file_name = os.path.join(folder, "facts.goviaji")
+            with open(file_name, "w") as f:
+                f.write("rule fact_a = fact a\n"
+                        "rule fact_b = fact b\n")
+
+            goviaji = Goviaji(file_name)
+
+        goals = [goviaji.str_to_expression("fact a"), goviaji.str_to_expression("fact b")] * 5000
+        steps, subs = next(prover.prove_dfs(goviaji.compiler.rules_db, goals))
+        self.assertIsNotNone(subs)
+        self.assertEqual(steps, 1)
+
+
+class LoopCheckTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with tempfile.TemporaryDirectory() as folder:
+            file_name = os.path.join(folder, "symmetry.goviaji")
+            with open(file_name, "w") as f:
+                f.write("rule similar_sym = similar X Y :- similar Y X\n"
+                        "rule similar_ab = similar a b\n")
+
+            cls.goviaji = Goviaji(file_name)
+
+        cls.goviaji.proof_steps_budget = 1000
+
+    def prove(self, query, loop_check):
+        self.goviaji.prover_cache.clear()
+        self.goviaji.loop_check = loop_check
+        return next(self.goviaji.prove([self.goviaji.str_to_expression(query)]))
+
+    def test_cycle(self):
+        steps, subs = self.prove("similar c a", False)
+        self.assertIsNone(subs)
+        self.assertGreaterEqual(steps, self.goviaji.proof_steps_budget)
+
+        steps, subs = self.prove("similar c a", True)
+        self.assertIsNone(subs)
+        self.assertLess(steps, 10)
+        self.assertGreater(self.goviaji.loop_stats["branches_pruned"], 0)
+
+        steps, subs = self.prove("similar b a", True)
+        self.assertIsNotNone(subs)
+
+    # r a fails below q a only because its proof through q a is cut, which must not mark it as false
+    def test_cut_goal_not_cached_as_false(self):
+        with tempfile.TemporaryDirectory() as folder:
+            file_name = os.path.join(folder, "mutual.goviaji")
+            with open(file_name, "w") as f:
+                f.write("rule q_r = q X :- r X\n"
+                        "rule r_q = r X :- q X\n"
+                        "rule q_a = q a :- base\n"
+                        "rule base = base\n")
+
+            goviaji = Goviaji(file_name)
+
+        goviaji.proof_steps_budget = 1000
+        goviaji.loop_check = True
+        steps, subs = next(goviaji.prove([goviaji.str_to_expression("q a")]))
+        self.assertIsNotNone(subs)
+        self.assertGreater(goviaji.loop_stats["branches_pruned"], 0)
+
+        steps, subs = next(goviaji.prove([goviaji.str_to_expression("r a")]))
+        self.assertIsNotNone(subs)
+
+
+class HashConsingTest(unittest.TestCase):
+    def test_equal_children_share_application(self):
+        x = Variable("X")
+        a, b = Constant("a"), Constant("b")
+        expr = expression_from_list([a, expression_from_list([b, x]), x])
+        self.assertIs(expression_from_list([a, expression_from_list([b, x]), x]), expr)
+        self.assertIs(Application(expr.elems[0], expr.elems[1]), expr)
+        self.assertIsNot(expression_from_list([a, expression_from_list([b, Variable("X")]), x]), expr)
+
+    def test_reinterned_after_collection(self):
+        a, b = Constant("a"), Constant("b")
+        expr = Application(a, b)
+        self.assertIs(interned_applications[a, b], expr)
+
+        del expr
+        gc.collect()
+        self.assertNotIn((a, b), interned_applications)
+
+        expr = Application(a, b)
+        self.assertIs(interned_applications[a, b], expr)
+        self.assertIs(Application(a, b), expr)
+
+    def test_cached_attributes(self):
+        x, y = Variable("X"), Variable("Y")
+        a, b = Constant("a"), Constant("b")
+        generated = Constant("_1", generated=True)
+
+        ground = expression_from_list([a, expression_from_list([b, a]), b])
+        self.assertTrue(ground.closed)
+        self.assertEqual(ground.variables, frozenset())
+
+        open_expr = expression_from_list([a, expression_from_list([x, expression_from_list([b, y])]), x])
+        self.assertFalse(open_expr.closed)
+        self.assertEqual(open_expr.variables, {x, y})
+        self.assertIs(open_expr.elems[0].variables, open_expr.elems[0].elems[1].variables)
+
+        with_generated = expression_from_list([a, expression_from_list([b, generated])])
+        self.assertFalse(with_generated.closed)
+        self.assertIsNone(with_generated.hash)
+        self.assertTrue(with_generated.elems[0].closed)
+        self.assertEqual(with_generated.variables, frozenset())
+
+        # a variant has the same hash, whatever the names of its variables and generated constants
+        renamed = expression_from_list([a, expression_from_list([y, expression_from_list([b, x])]), y])
+        self.assertEqual(renamed.get_hash(), open_expr.get_hash())
+        self.assertEqual(expression_from_list([a, expression_from_list([b, Constant("_2", generated=True)])])
+                         .get_hash(), with_generated.get_hash())
+
+
+class BindingsTest(unittest.TestCase):
+    def setUp(self):
+        self.x, self.y, self.z = Variable("X"), Variable("Y"), Variable("Z")
+        self.f, self.a, self.b = Constant("f"), Constant("a"), Constant("b")
+
+    def test_occurs_check(self):
+        bindings = Bindings()
+        self.assertFalse(bindings.unify(self.x, expression_from_list([self.f, self.x])))
+
+        # X occurs in f Y only through the binding of Y
+        bindings = Bindings()
+        self.assertTrue(bindings.unify(self.y, expression_from_list([self.a, self.x])))
+        self.assertFalse(bindings.unify(self.x, expression_from_list([self.f, self.y])))
+
+    def test_variable_chains(self):
+        bindings = Bindings()
+        self.assertTrue(bindings.unify(self.x, self.y))
+        self.assertTrue(bindings.unify(self.y, self.z))
+        self.assertIs(bindings.find(self.x), self.z)
+        self.assertTrue(bindings.unify(self.z, self.a))
+        self.assertIs(bindings.find(self.x), self.a)
+        self.assertIs(bindings.bound[self.x], self.a)
+        self.assertFalse(bindings.unify(self.x, self.b))
+        self.assertTrue(bindings.unify(self.x, self.x))
+
+    def test_ground_clash(self):
+        bindings = Bindings()
+        self.assertFalse(bindings.unify(expression_from_list([self.f, self.a]), expression_from_list([self.f, self.b])))
+        self.assertFalse(bindings.unify(expression_from_list([self.f, self.a]), self.a))
+        self.assertTrue(bindings.unify(expression_from_list([self.f, self.a]), expression_from_list([self.f, self.a])))
+        self.assertFalse(bindings.unify(expression_from_list([self.f, self.x, self.a]),
+                                        expression_from_list([self.f, self.b, self.b])))
+
+    def test_to_substitution(self):
+        bindings = Bindings()
+        self.assertTrue(bindings.unify(expression_from_list([self.f, self.x, self.y]),
+                                       expression_from_list([self.f, expression_from_list([self.f, self.y]), self.z])))
+        self.assertTrue(bindings.unify(self.z, self.a))
+        subs = bindings.to_substitution()
+        self.assertEqual(set(subs.replacements), {self.x, self.y, self.z})
+        self.assertIs(subs.replacements[self.x], expression_from_list([self.f, self.a]))
+        self.assertIs(subs.replacements[self.y], self.a)
+        self.assertIs(subs.replacements[self.z], self.a)
+
+
+class AnswerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with tempfile.TemporaryDirectory() as folder:
+            file_name = os.path.join(folder, "paths.goviaji")
+            with open(file_name, "w") as f:
+                f.write("rule edge_ab = a edge b\n"
+                        "rule edge_bc = b edge c\n"
+                        "rule path2 = X path2 Y :- X edge Z, Z edge Y\n"
+                        "rule route = X route (via Y Z) :- X path2 Z, Y edge Z\n")
+
+            cls.goviaji = Goviaji(file_name)
+
+    # the answer of every strategy of the prover, built up in the search nodes over the steps of the proof
+    def test_multi_step_answer(self):
+        goal = self.goviaji.str_to_expression("X route T")
+        x, t = sorted(goal.variables, key=lambda v: v.name, reverse=True)
+        for strategy in prover.search_strategies:
+            steps, subs = next(prover.prove_dfs(self.goviaji.compiler.rules_db, [goal], search_strategy=strategy))
+            self.assertEqual(set(subs.replacements), {x, t}, strategy)
+            self.assertEqual(subs.replacements[x].to_str(), "a", strategy)
+            self.assertEqual(subs.replacements[t].to_str(), "via b c", strategy)
+
+    # exhausting the alternatives of the goals of the proposition does not mark them as false once they have answers
+    def test_proposition_goals_proven(self):
+        proposition = self.goviaji.str_to_proposition(["X edge Y", "Y edge Z"])[0]
+        tried_goals = {}
+        answers = [subs for steps, subs in prover.prove_dfs(self.goviaji.compiler.rules_db, proposition,
+                                                            tried_goals=tried_goals) if subs is not None]
+        self.assertEqual(len(answers), 1)
+        for goal in proposition:
+            self.assertIs(tried_goals[goal.get_hash()], True, goal.to_str())
+
+    def test_node_path(self):
+        self.assertEqual(search.node_path(None), [])
+        self.assertEqual(search.node_path(("c", ("b", ("a", None)))), ["a", "b", "c"])
+
+        # siblings share the nodes of their common prefix
+        parent = "b", ("a", None)
+        self.assertEqual(search.node_path(("c", parent)), ["a", "b", "c"])
+        self.assertEqual(search.node_path(("d", parent)), ["a", "b", "d"])
+
+        neighbors = {"a": ["b", "c"], "b": ["d"], "c": ["e"], "d": [], "e": []}
+        steps, path = next(search.depth_first_search("a", neighbors.__getitem__, lambda v: v == "e"))
+        self.assertEqual(path, ["a", "c", "e"])
+
+    # every iteration finds the goals of the earlier ones again, which are only reported once with a key
+    def test_iterative_deepening_goals(self):
+        neighbors = {"a": ["g", "b"], "b": ["c"], "c": ["h", "d"], "d": ["i"], "g": [], "h": [], "i": []}
+        goals = [path for steps, path in search.iterative_deepening_search("a", neighbors.__getitem__,
+                                                                           lambda v: v in "ghi", key=lambda v: v)]
+        self.assertEqual(goals, [["a", "g"], ["a", "b", "c", "h"], ["a", "b", "c", "d", "i"], None])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
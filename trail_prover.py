@@ -0,0 +1,256 @@
+import time
+from substitution import Substitution
+from expressions import Expression, Variable, Application
+from prover import GoalProvedMark, FailMark, ProofTimeout
+
+
+# Goal lists are linked lists of (item, rest, pending) cells shared between the branches of the search, pending
+# being the number of goals and fail marks in the list. A list with nothing pending is a proof
+def push(item, rest):
+    pending = rest[2] if rest is not None else 0
+    if isinstance(item, (Expression, FailMark)):
+        pending += 1
+
+    return item, rest, pending
+
+
+def has_pending(goals):
+    return goals is not None and goals[2] > 0
+
+
+# Proves goals like prove_dfs, with the same marks and search order, but variables are bound destructively and the
+# bindings are undone from a trail when the search backtracks. The goals after the first one are shared with the
+# parent branch as they are, and are only resolved against the bindings when they become the first goal
+class TrailProver:
+    def __init__(self, rules, tried_goals, verbose=False, goals_by_hash=None):
+        self.rules = rules
+        self.tried_goals = tried_goals
+        self.verbose = verbose
+        self.goals_by_hash = goals_by_hash
+        # the goals missing from tried_goals, by hash, recorded in goals_by_hash once they are given a result
+        self.looked_up = {}
+        self.bindings = {}
+        self.trail = []
+
+    def bind(self, var, value):
+        self.bindings[var] = value
+        self.trail.append(var)
+
+    def record_goal(self, h, goal, in_cache):
+        if self.goals_by_hash is not None:
+            if in_cache:
+                self.goals_by_hash[h] = goal
+            else:
+                self.looked_up[h] = goal
+
+    def store_result(self, h, result):
+        self.tried_goals[h] = result
+        if self.goals_by_hash is not None and h in self.looked_up:
+            self.goals_by_hash[h] = self.looked_up[h]
+
+    def undo(self, trail_length):
+        while len(self.trail) > trail_length:
+            del self.bindings[self.trail.pop()]
+
+    def resolve(self, expr, resolved=None):
+        if not any(v in self.bindings for v in expr.variables):
+            return expr
+
+        if isinstance(expr, Variable):
+            return self.resolve(self.bindings[expr], resolved)
+
+        if resolved is None:
+            resolved = {}
+        elif expr in resolved:
+            return resolved[expr]
+
+        left, right = expr.elems
+        result = Application(self.resolve(left, resolved), self.resolve(right, resolved))
+        resolved[expr] = result
+        return result
+
+    def accept_proof_marks(self, goals):
+        while goals is not None:
+            item = goals[0]
+            if isinstance(item, GoalProvedMark):
+                if item.hash not in self.tried_goals:
+                    if self.verbose:
+                        print("*** hash=%d marked as %s" % (item.hash, item.result))
+
+                    self.store_result(item.hash, item.result)
+            elif isinstance(item, FailMark):
+                if not item.goal_check_hash or \
+                        (item.goal_check_hash in self.tried_goals and self.tried_goals[item.goal_check_hash]):
+                    break
+            else:
+                break
+
+            goals = goals[1]
+
+        return goals
+
+    # the alternatives for the first goal that has to branch, as (bindings, goals) pairs
+    def expand(self, goals):
+        while True:
+            goals = self.accept_proof_marks(goals)
+            if goals is None:
+                return [((), None)]
+
+            first_goal, rest = goals[0], goals[1]
+            if isinstance(first_goal, FailMark):
+                return []
+
+            first_goal = self.resolve(first_goal)
+            h = first_goal.get_hash()
+            is_ground = first_goal.is_ground()
+            if self.verbose:
+                print("Current goal is \"%s\", hash=%d, %s" %
+                      (first_goal.to_str(), h, "ground" if is_ground else "not ground"))
+
+            in_cache = h in self.tried_goals
+            self.record_goal(h, first_goal, in_cache)
+            if in_cache:
+                if not self.tried_goals[h]:
+                    return []
+
+                if is_ground:
+                    goals = rest
+                    continue
+
+            alternatives = []
+            proven_without_branching = False
+            for new_subs, rule in self.rules.get_applicable_rules(first_goal):
+                if self.verbose:
+                    print("\tRule %s is applicable with substitution [%s]" % (rule.name, new_subs))
+
+                if not rule.premises:
+                    rest = self.accept_proof_marks(rest)
+                    if is_ground:
+                        proven_without_branching = True
+                        break
+
+                    alternatives.append((self.goal_bindings(new_subs, rule), rest))
+                    continue
+
+                new_goals = list(map(new_subs.apply, rule.premises))
+                new_goals_vars = set()
+                for e in new_goals:
+                    e.collect_variables(new_goals_vars)
+
+                refresh_subs = self.rules.refreshing_substitution(new_goals_vars & rule.variables)
+                new_goals = list(map(refresh_subs.apply, new_goals))
+                new_subs.compose(refresh_subs, add=False)
+
+                new_goals_with_marks = []
+                if is_ground:
+                    new_goals_with_marks.append(FailMark(h))
+
+                rule_failed = False
+                for g in new_goals:
+                    sub_hash = g.get_hash()
+                    in_cache = sub_hash in self.tried_goals
+                    self.record_goal(sub_hash, g, in_cache)
+                    if in_cache:
+                        if not self.tried_goals[sub_hash]:
+                            rule_failed = True
+                            break
+
+                        if g.is_ground():
+                            continue
+
+                    new_goals_with_marks.append(g)
+                    new_goals_with_marks.append(GoalProvedMark(sub_hash, True))
+
+                if rule_failed:
+                    continue
+
+                if not new_goals_with_marks:
+                    rest = self.accept_proof_marks(rest)
+                    if is_ground:
+                        proven_without_branching = True
+                        break
+
+                new_goals_list = rest
+                for item in reversed(new_goals_with_marks):
+                    new_goals_list = push(item, new_goals_list)
+
+                alternatives.append((self.goal_bindings(new_subs, rule), new_goals_list))
+
+            if proven_without_branching:
+                goals = rest
+                continue
+
+            if not alternatives:
+                self.store_result(h, False)
+                return []
+
+            alternatives.append(((), push(GoalProvedMark(h, False), push(FailMark(), None))))
+            return alternatives
+
+    # the bindings of the variables of the goal, leaving out those of the variables of the rule
+    @staticmethod
+    def goal_bindings(subs, rule):
+        return tuple((var, expr) for var, expr in subs.items() if var not in rule.variables)
+
+    def answer(self, query_vars):
+        subs = Substitution()
+        for var in query_vars:
+            value = self.resolve(var)
+            if value is not var:
+                subs.replace(var, value)
+
+        return subs
+
+
+# ProofTimeout is raised when a node is expanded after deadline, a time.perf_counter() value
+def prove_trail(rules, proposition, steps_budget=None, tried_goals=None, verbose=False, goals_by_hash=None,
+                deadline=None):
+    if verbose:
+        print("Starting trail proof of \"%s\"" % ", ".join(p.to_str() for p in proposition))
+
+    if tried_goals is None:
+        tried_goals = {}
+
+    query_vars = []
+    for e in proposition:
+        query_vars.extend(v for v in e.variables if v not in query_vars)
+
+    # as in prove_dfs, the goals of the proposition are marked as proven like premises
+    goals = None
+    for g in reversed(proposition):
+        goals = push(g, push(GoalProvedMark(g.get_hash(), True), goals))
+
+    prover = TrailProver(rules, tried_goals, verbose, goals_by_hash)
+    # search nodes are the length of the trail of their parent, the bindings leading to them and their goals
+    stack = [(0, (), goals)]
+    steps_taken = 0
+    while stack:
+        steps_taken += 1
+        if steps_budget is not None and steps_taken >= steps_budget:
+            yield steps_taken, None
+            return
+
+        if deadline is not None and time.perf_counter() > deadline:
+            raise ProofTimeout()
+
+        trail_length, bindings, goals = stack.pop()
+        prover.undo(trail_length)
+        for var, value in bindings:
+            prover.bind(var, value)
+
+        trail_length = len(prover.trail)
+        new_nodes = []
+        for alternative_bindings, alternative_goals in prover.expand(goals):
+            if has_pending(alternative_goals):
+                new_nodes.append((trail_length, alternative_bindings, alternative_goals))
+                continue
+
+            for var, value in alternative_bindings:
+                prover.bind(var, value)
+
+            yield steps_taken, prover.answer(query_vars)
+            prover.undo(trail_length)
+
+        stack.extend(reversed(new_nodes))
+
+    yield steps_taken, None